@@ -1,4 +1,4 @@
-import simsym, z3
+import simsym, z3, z3ast
 
 def reduce_array_ext(expr):
     """Find a subset of expr that still produces array-ext in models.
@@ -52,7 +52,7 @@ def dump(expr):
             have.add(name)
             print '%s = Const(%r, %s)' % (name, name, sort_ctor(sort))
 
-    def rec(e):
+    for e in z3ast.walk(expr):
         if isinstance(e, z3.QuantifierRef):
             for n in range(e.num_vars()):
                 mkvar(e.var_name(n), e.var_sort(n))
@@ -63,8 +63,4 @@ def dump(expr):
             pass
         elif z3.is_const(e):
             mkvar(str(e), e.sort())
-
-        for sub in e.children():
-            rec(sub)
-    rec(expr)
     print expr
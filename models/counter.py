@@ -2,6 +2,9 @@ import simsym
 import model
 
 class Counter(simsym.tstruct(counter=simsym.SInt)):
+    # Identical calls are interchangeable (see simtest.test)
+    symmetric_calls = True
+
     def _declare_assumptions(self, assume):
         super(Counter, self)._declare_assumptions(assume)
         assume(self.counter >= 0)
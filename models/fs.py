@@ -9,11 +9,14 @@ import fs_testgen
 
 # ckx: 符号化状态 (interface,参数，状态三要素之一的状态)
 
-SFn = simsym.tuninterpreted("SFn")
-SInum = simsym.tuninterpreted("SInum")
+# Bounds come from the value pools in fs_testgen (see
+# simsym.options.finite_domains)
+SFn = simsym.tuninterpreted("SFn", len(fs_testgen.all_filenames))
+SInum = simsym.tuninterpreted("SInum", fs_testgen.inode_count)
 SDataVal = simsym.tuninterpreted("SDataVal")
-SVa = simsym.tuninterpreted("SVa")
-SPipeId = simsym.tuninterpreted("SPipeId")
+SVa = simsym.tuninterpreted("SVa", fs_testgen.va_len)
+SPipeId = simsym.tuninterpreted(
+    "SPipeId", (fs_testgen.pipe_end - fs_testgen.pipe_begin) / 2)
 
 DATAVAL_BYTES = 4096
 PAGE_BYTES = 4096
@@ -9,6 +9,8 @@ all_filenames = ['__f%d' % x for x in range(0, 6)]
 fd_begin = 10
 fd_end = 20
 
+inode_count = 6
+
 pipe_begin = 20   ## even is reader, odd is writer
 pipe_end = 30
 
@@ -52,7 +54,7 @@ class FsState(object):
     self.filenames = testgen.Interpreter(fs_module.SFn, all_filenames)
     # Map from SInum to concrete Inode object
     self.inums = testgen.Interpreter(
-      fs_module.SInum, map(Inode, range(0, 6)))
+      fs_module.SInum, map(Inode, range(0, inode_count)))
     # Map from SDataVal to DataVal
     self.datavals = testgen.Interpreter(fs_module.SDataVal, all_datavals,
                                         enumerate=False)
@@ -3,6 +3,9 @@ import symtypes
 import model
 
 class Var(simsym.tstruct(val=simsym.SInt)):
+    # Identical calls are interchangeable (see simtest.test)
+    symmetric_calls = True
+
     @model.methodwrap(val=simsym.SInt)
     def set(self, val):
         self.val = val
@@ -15,6 +15,8 @@ SymDir      = symtypes.tdict(SymFilename, simsym.SInt)
 class Rename(simsym.tstruct(
         fname_to_inum=SymDir,
         inodes=SymIMap)):
+    # Identical calls are interchangeable (see simtest.test)
+    symmetric_calls = True
 
     @model.methodwrap(src=SymFilename, dst=SymFilename)
     def rename(self, src, dst):
@@ -4,25 +4,98 @@ import spec
 import multiprocessing
 import re
 import copy
-import json
-import collections
 import traceback
 import sys
+import os
 import importlib
+import shutil
+import tempfile
 
-def wrapped_main(*args):
-    # Blarg!  multiprocessing eats tracebacks
+class Tee(object):
+    """A file object that writes to several files."""
+
+    def __init__(self, *fps):
+        self.fps = fps
+
+    def write(self, data):
+        for fp in self.fps:
+            fp.write(data)
+
+    def flush(self):
+        for fp in self.fps:
+            fp.flush()
+
+    def fileno(self):
+        return self.fps[-1].fileno()
+
+def wrapped_main(csargs, stdout_path=None):
+    # Pool processes run several call sets, so restore stdout after
+    # capturing it for the result cache
+    stdout = sys.stdout
     try:
-        return spec.main(*args)
+        if stdout_path:
+            sys.stdout = Tee(stdout, file(stdout_path, "w"))
+        return spec.main(csargs)
     except Exception as e:
+        # Blarg!  multiprocessing eats tracebacks
         tb = traceback.format_exc()
-        msg = "Exception in child %s:\n%s" % (args, tb)
+        msg = "Exception in child %s:\n%s" % (csargs, tb)
         print >>sys.stderr, msg
         raise Exception(msg)
+    finally:
+        if sys.stdout is not stdout:
+            sys.stdout.fps[-1].close()
+            sys.stdout = stdout
+
+# Per-call set output files saved and restored by --result-cache
+CACHED_OUTPUTS = ["model_file", "trace_file", "sched_graph", "query_trace",
+                  "test_file"]
+
+def cache_restore(csargs, key):
+    """Restore csargs's outputs from the result cache entry for key.
+
+    Returns False if the entry is missing or lacks an output csargs
+    asks for.
+    """
+    entry = os.path.join(args.result_cache, key)
+    names = [name for name in CACHED_OUTPUTS if getattr(csargs, name)]
+    for name in names + ["stdout"]:
+        if not os.path.exists(os.path.join(entry, name)):
+            return False
+    for name in names:
+        shutil.copyfile(os.path.join(entry, name), getattr(csargs, name))
+    sys.stdout.write(file(os.path.join(entry, "stdout")).read())
+    return True
+
+def cache_store(csargs, key, stdout_path):
+    """Save the outputs of csargs's run as the cache entry for key."""
+    tmp = tempfile.mkdtemp(dir=args.result_cache)
+    for name in CACHED_OUTPUTS:
+        if getattr(csargs, name):
+            shutil.copyfile(getattr(csargs, name), os.path.join(tmp, name))
+    shutil.move(stdout_path, os.path.join(tmp, "stdout"))
+    # Replace any entry with fewer outputs
+    entry = os.path.join(args.result_cache, key)
+    if os.path.exists(entry):
+        shutil.rmtree(entry)
+    os.rename(tmp, entry)
 
 args = spec.parser.parse_args()
-callsets = spec.parse_functions(
-    args.functions, args.ncomb, importlib.import_module(args.module))
+if args.path_workers > 1:
+    # Pool processes are daemonic and cannot start path workers
+    spec.parser.error("--path-workers cannot be used with par-spec")
+# The model's types depend on this, and we import the model here
+spec.simsym.options.finite_domains = args.finite_domains
+if args.resume and not args.journal:
+    spec.parser.error("--resume requires --journal")
+if args.skip_disjoint and (args.model_file or args.test_file):
+    # Check here rather than in every call set's process
+    spec.parser.error("--skip-disjoint would omit skipped callsets from "
+                      "the model and test files")
+module = importlib.import_module(args.module)
+callsets = spec.parse_functions(args.functions, args.ncomb, module)
+if args.result_cache and not os.path.isdir(args.result_cache):
+    os.makedirs(args.result_cache)
 pool = multiprocessing.Pool()
 subargs = []
 asyncs = []
@@ -33,25 +106,54 @@ for i, callset in enumerate(callsets):
         csargs.model_file += suffix
     if csargs.trace_file:
         csargs.trace_file += suffix
+    if csargs.query_trace:
+        csargs.query_trace += suffix
+    if csargs.sched_graph:
+        # Keep the extension, which selects the graph format
+        root, ext = os.path.splitext(csargs.sched_graph)
+        csargs.sched_graph = root + suffix + ext
     if csargs.test_file:
         csargs.test_file += suffix
+    if csargs.journal:
+        csargs.journal += suffix
     csargs.functions = "/".join(callset)
-    asyncs.append(pool.apply_async(wrapped_main, [csargs]))
     subargs.append(csargs)
+    if args.resume and os.path.exists(csargs.journal):
+        try:
+            done, _ = spec.read_journal(
+                csargs.journal, spec.run_fingerprint(csargs, module))
+        except ValueError:
+            done = set()
+        if "_".join(callset) in done:
+            # Keep the earlier run's outputs for this call set
+            continue
+    key = stdout_path = None
+    if args.result_cache:
+        key = spec.callset_key(csargs, module, callset)
+        csargs.result_cache = None
+        if cache_restore(csargs, key):
+            continue
+        stdout_path = os.path.join(args.result_cache,
+                                   "stdout.%d%s" % (os.getpid(), suffix))
+    if csargs.test_file or \
+       (csargs.model_file and csargs.model_format != "stream"):
+        # These outputs can't be added to, so unfinished call sets
+        # start over
+        csargs.resume = False
+    asyncs.append((csargs, key, stdout_path,
+                   pool.apply_async(wrapped_main, [csargs, stdout_path])))
 pool.close()
-for async in asyncs:
+for csargs, key, stdout_path, async in asyncs:
     # This is the only way to propagate exceptions up
     async.get()
+    if key:
+        cache_store(csargs, key, stdout_path)
 pool.join()
 
 print "Model execution complete"
 
 def merge_model_files(ins, out):
-    data = {"tests": collections.OrderedDict()}
-    for inpath in ins:
-        d = json.load(file(inpath), object_pairs_hook=collections.OrderedDict)
-        data["tests"].update(d["tests"])
-    json.dump(data, file(out, "w"), indent=2)
+    spec.modelfile.merge(ins, out, args.model_format == "stream")
 
 def merge_trace_files(ins, out):
     outf = file(out, "w")
@@ -95,6 +197,17 @@ if args.trace_file:
     print "Merging trace files..."
     merge_trace_files([subarg.trace_file for subarg in subargs], args.trace_file)
 
+if args.sched_graph:
+    # DOT tools accept a file with several graphs
+    print "Merging execution graph files..."
+    merge_trace_files([subarg.sched_graph for subarg in subargs],
+                      args.sched_graph)
+
+if args.query_trace:
+    print "Merging query traces..."
+    merge_trace_files([subarg.query_trace for subarg in subargs],
+                      args.query_trace)
+
 if args.test_file:
     print "Merging test files..."
     merge_test_files([subarg.test_file for subarg in subargs], args.test_file)
@@ -5,8 +5,21 @@ import os
 import z3
 import types
 import collections
+import itertools
 import inspect
+import traceback
+import signal
+import select
+import time
+import random
+import cPickle
+import atexit
+import json
+import heapq
+import multiprocessing
+import Queue
 import graph
+import z3util
 
 class options(object):
     # If set, equality tests eagerly simplify expressions that are
@@ -17,6 +30,153 @@ class options(object):
     # when tracing symbolic execution.
     eq_eliminate_structural = True
 
+    # If set, symbolic_apply explores code paths in a tree of forked
+    # checkpoint processes instead of replaying each schedule from the
+    # beginning.  At every non-deterministic branch, the executor
+    # forks and each side of the branch resumes from the checkpoint
+    # with its solver state intact.  The checkpoints report their
+    # branch decisions back to the calling process, which
+    # reconstitutes each path from these decisions without consulting
+    # the solver, so the results are identical to replay mode.
+    fork_checkpoints = False
+
+    # If set, symbolic execution is concolic: at each branch, the
+    # current path follows the side that holds in a model of its path
+    # condition, which needs no solver query, and the other side is
+    # only checked for feasibility when a later path follows it.
+    # Branches on constant conditions never consult the solver.
+    # Alternatives that turn out to be infeasible produce no path.
+    # Paths come out in model order, except with path_workers, which
+    # always yields the true side of a branch first.  A branch the
+    # model decided counts as non-deterministic in path IDs even if
+    # its other side turns out to be infeasible, so path IDs differ
+    # from other modes, but it doesn't count toward max_path_depth.
+    concolic = False
+
+    # If set, simtest.test calls each model method through merge_call,
+    # which merges the method's code paths that return the same kind
+    # of result into a single path.
+    merge_calls = False
+
+    # If set, simtest.test runs each call of a call set on the initial
+    # state first and drops paths on which identical calls (such as
+    # rename/rename) take their branches out of order, since swapping
+    # those calls' arguments gives a mirror image of the path.
+    # test_callset expands the commutativity conditions with the
+    # mirror images of the dropped paths (see simtest.mirror_images),
+    # but dropped paths get no tests of their own.  This only applies
+    # to model classes that set symmetric_calls (see simtest.test),
+    # and can't be combined with merge_calls, which doesn't branch the
+    # same way in mirror images.
+    break_call_symmetry = False
+
+    # If set, uninterpreted types created with a bound (see
+    # tuninterpreted) have exactly that many values, and exists and
+    # forall expand quantifiers over these types into quantifier-free
+    # disjunctions and conjunctions.  This must be set before the
+    # model's types are created.
+    finite_domains = False
+
+    # Maximum number of solver query results to keep in query_cache.
+    # The cache is shared by all paths and call sets, and answers
+    # queries whose conjuncts are a superset of a cached unsat query
+    # or are satisfied by a cached model.  0 disables the cache.
+    query_cache_size = 4096
+
+    # Maximum number of simplify results to cache.  0 disables the
+    # cache.
+    simplify_cache_size = 1024
+
+    # If not None, the number of seconds each solver check may take
+    # before it gives up with an unknown result.
+    solver_timeout = None
+
+    # Solver strategies to race in separate processes when a check
+    # returns unknown (including on timeout).  The first definitive
+    # answer wins.  Each strategy is "fresh" for a new solver,
+    # "seed:N" for a new solver with random seed N, or "tactic:NAME"
+    # for a solver built from Z3 tactic NAME (e.g., "tactic:qfaufbv"
+    # for quantifier-free queries).  A tactic only decides queries in
+    # its fragment and answers unknown on the rest.  Queries about
+    # symtypes lists quantify over integer indexes even with
+    # finite_domains, so quantifier-free tactics rarely help with the
+    # unknowns of models built on them.  If this is empty, path checks
+    # are retried once in a fresh solver in this process and other
+    # checks are not retried.
+    portfolio = ()
+
+    # If not None, the file to write a JSON record to, one per line,
+    # for every solver query and simplification.  Each record gives
+    # the query kind, duration, result, the size of the queried
+    # expression, and the model source line that caused it.  See
+    # tools/query-report.
+    query_trace_file = None
+
+    # If not None, the directory to write every solver query to as an
+    # SMT-LIB2 file.  Each file begins with a comment giving the same
+    # information as a query trace record.  See tools/query-bench.
+    query_dump_dir = None
+
+    # Number of worker processes symbolic_apply uses to explore the
+    # code paths of a single application.  Workers take queued
+    # schedules from a shared queue, extend them, and queue the
+    # alternatives they find for other workers.  The calling process
+    # reconstitutes each finished path from its decisions and yields
+    # the paths in the same order as replay mode.  0 or 1 explores
+    # paths in the calling process.
+    path_workers = 0
+
+    # The order in which symbolic_apply explores queued schedules in
+    # replay mode.  This must name one of Scheduler.strategies.
+    search_strategy = "dfs"
+
+    # Seed for the "random" search strategy.
+    search_seed = 0
+
+    # If not None, the maximum number of non-deterministic branches on
+    # a code path.  A path that reaches a non-deterministic branch
+    # beyond this depth ends there with a PathDepthExceeded exception
+    # result, and simtest.test_callset reports the call set incomplete.
+    # Branches decided by a model in concolic mode don't count.
+    max_path_depth = None
+
+    # If not None, the file to stream the execution graph of each
+    # symbolic_apply to.  If the name ends in .jsonl, the graph is
+    # written as JSON records, one per line; otherwise it is written
+    # in DOT format.  Recording costs nothing when this is None.
+    sched_graph_file = None
+
+    # Record only every sched_graph_sample'th path in the execution
+    # graph.
+    sched_graph_sample = 1
+
+# Extra fields for query trace records, such as the current call set
+query_trace_info = {}
+
+class stats(object):
+    # Total seconds spent in solver checks.  This includes the time
+    # path workers and forked checkpoints spent on each path once that
+    # path finishes.
+    solver_time = 0.0
+
+def _work_counters():
+    """Return this process's counts of the work it has done.
+
+    Checkpoint and worker processes report how much these grew while
+    they explored a path (see _work_since).
+    """
+    return (stats.solver_time, query_cache.hits, query_cache.misses)
+
+def _work_since(base):
+    """Return the growth of _work_counters since base."""
+    return tuple(now - then for now, then in zip(_work_counters(), base))
+
+def _count_work(work):
+    """Add work reported by a checkpoint or worker process."""
+    stats.solver_time += work[0]
+    query_cache.hits += work[1]
+    query_cache.misses += work[2]
+
 # Monkey-patch __nonzero__ on Z3 types to make sure we don't
 # accidentally call it instead of our wrappers.
 def z3_nonzero(self):
@@ -221,6 +381,7 @@ class Symbolic(object):
                 for k in a.keys():
                     if k not in b or not rec(a[k], b[k]):
                         return False
+                return True
             elif z3.is_ast(a):
                 return z3.is_ast(b) and a.eq(b)
             else:
@@ -314,6 +475,72 @@ def flatten_compound(compound):
     rec(compound)
     return res
 
+# The "shape" of a compound sort determines the canonical order of
+# its leafs when it is stored flat.  The shape of a non-compound sort
+# is None.  The shape of a compound sort is a tuple of (key, shape)
+# pairs, sorted by key.
+
+def compound_shape(sort):
+    """Return the shape of compound sort."""
+    if isinstance(sort, dict):
+        return tuple((k, compound_shape(sort[k])) for k in sorted(sort))
+    return None
+
+def shape_width(shape):
+    """Return the number of leafs in a compound of the given shape."""
+    if shape is None:
+        return 1
+    return sum(shape_width(sub) for _, sub in shape)
+
+def flatten_shaped(shape, compound, out=None):
+    """Append compound's leafs to out in the canonical order for shape.
+
+    Returns out, which defaults to a new list.
+    """
+    if out is None:
+        out = []
+    if shape is None:
+        out.append(compound)
+    else:
+        for k, sub in shape:
+            flatten_shaped(sub, compound[k], out)
+    return out
+
+def unflatten_shaped(shape, leafs):
+    """Return the compound of the given shape with leafs from iterator leafs.
+
+    This is the inverse of flatten_shaped.
+    """
+    if shape is None:
+        return next(leafs)
+    return {k: unflatten_shaped(sub, leafs) for k, sub in shape}
+
+class _Cell(object):
+    """Flat, copy-on-write storage for the leafs of a compound lvalue.
+
+    snapshot returns a cell sharing the same leaf list.  Whichever
+    cell is written first copies the list, so snapshots are O(1).
+    """
+
+    __slots__ = ["leafs", "shared"]
+
+    def __init__(self, leafs):
+        self.leafs = leafs
+        self.shared = False
+
+    def snapshot(self):
+        self.shared = True
+        res = _Cell(self.leafs)
+        res.shared = True
+        return res
+
+    def set(self, start, leafs):
+        """Replace the leafs beginning at index start."""
+        if self.shared:
+            self.leafs = list(self.leafs)
+            self.shared = False
+        self.leafs[start:start + len(leafs)] = leafs
+
 #
 # Z3 wrappers
 #
@@ -464,6 +691,23 @@ class UncheckableConstraintError(RuntimeError):
 class UnsatisfiablePath(RuntimeError):
     pass
 
+class InfeasibleBranch(RuntimeError):
+    """Raised when a path follows a concolic alternative (see
+    options.concolic) that turns out to be infeasible.  Such a path
+    produces no result."""
+    pass
+
+class PrunedPath(InfeasibleBranch):
+    """Raised by code under symbolic execution to drop the current path
+    because another path covers it.  Such a path produces no result."""
+    pass
+
+class PathDepthExceeded(UncheckableConstraintError):
+    def __init__(self, expr, depth):
+        UncheckableConstraintError.__init__(
+            self, expr, "path depth limit (%d) exceeded" % depth)
+        self.depth = depth
+
 class ReplayDivergedError(RuntimeError):
     def __init__(self, old, new):
         RuntimeError.__init__(
@@ -474,76 +718,102 @@ class SBool(SExpr, SymbolicConst):
     __pass_type__ = bool
     __z3_sort__ = z3.BoolSort()
 
+    def __explore(self, oracle):
+        """Return the SchedNodes for the feasible sides of this branch.
+
+        The first node is the side the current path should follow.
+        Any remaining nodes are alternatives that must be explored by
+        other paths.
+        """
+
+        # If the oracle's model decides one side, this costs only one
+        # solver query for the other side.
+        canTrue, canTrueReason = oracle.check(self._v)
+        canFalse, canFalseReason = oracle.check(z3.Not(self._v))
+
+        if canTrue == z3.unsat and canFalse == z3.unsat:
+            raise RuntimeError("Branch contradiction")
+
+        if canTrue == z3.sat and canFalse == z3.unsat:
+            return [SchedNode("branch_det", self, True)]
+        elif canTrue == z3.unsat and canFalse == z3.sat:
+            return [SchedNode("branch_det", self, False)]
+
+        # Both are possible (or at least one is unknown).  If one
+        # side is unsat and the other unknown, there's actually only
+        # one way to go.
+        nodes = []
+        if canTrue == z3.sat:
+            nodes.append(SchedNode("branch_nondet", self, True))
+        elif canTrue == z3.unknown:
+            nodes.append(SchedNode("exception", True,
+                                   UncheckableConstraintError(
+                                       self._v, canTrueReason)))
+        if canFalse == z3.sat:
+            nodes.append(SchedNode("branch_nondet", self, False))
+        elif canFalse == z3.unknown:
+            nodes.append(SchedNode("exception", False,
+                                   UncheckableConstraintError(
+                                       z3.Not(self._v), canFalseReason)))
+        return nodes
+
+    def __explore_concolic(self, oracle):
+        """Return the SchedNodes for this branch in concolic mode.
+
+        The first node is the side that holds in the oracle's model of
+        the path condition.  The second, if any, is an unchecked node
+        for the other side, which PathState.resolve checks once a path
+        follows it.
+        """
+
+        z3val = z3.simplify(self._v)
+        if z3.is_true(z3val) or z3.is_false(z3val):
+            return [SchedNode("branch_det", self, z3.is_true(z3val))]
+        val = oracle.evaluate(self._v)
+        if val is None:
+            return self.__explore(oracle)
+        taken = SchedNode("branch_nondet", self, val)
+        taken.model_decided = True
+        return [taken, SchedNode("branch_unchecked", self, not val)]
+
     def __nonzero__(self):
         if self._model and self._model is not MODEL_FETCH:
             return self.val
 
         scheduler, path_state = Env.scheduler(), Env.path_state()
-        solver = path_state.solver
+        oracle = path_state.oracle
         cursched = path_state.sched
 
         if len(cursched) == path_state.schedidx:
             # We've reached the end of replay; extend the schedule
-            solver.push()
-            solver.add(self._v)
-            canTrue = solver.check()
-            canTrueReason = solver.reason_unknown()
-            if canTrue == z3.unknown:
-                # Stack operations change how Z3 "compiles" formulas,
-                # so it's possible it can solve it in isolation.
-                s2 = z3.Solver()
-                s2.add(*solver.assertions())
-                canTrue = s2.check()
-                canTrueReason = s2.reason_unknown()
-            solver.pop()
-
-            solver.push()
-            solver.add(z3.Not(self._v))
-            canFalse = solver.check()
-            canFalseReason = solver.reason_unknown()
-            if canFalse == z3.unknown:
-                s2 = z3.Solver()
-                s2.add(*solver.assertions())
-                canFalse = s2.check()
-                canFalseReason = s2.reason_unknown()
-            solver.pop()
-
-            if canTrue == z3.unsat and canFalse == z3.unsat:
-                raise RuntimeError("Branch contradiction")
-
-            # Extend the schedule
-            if canTrue == z3.sat and canFalse == z3.unsat:
-                cursched.append(SchedNode("branch_det", self, True))
-            elif canTrue == z3.unsat and canFalse == z3.sat:
-                cursched.append(SchedNode("branch_det", self, False))
+            decision = path_state.planned()
+            if decision is not None:
+                # We're following a plan; take the decision that was
+                # made when this path was explored
+                path_state.follow(SchedNode.from_decision(decision, self))
             else:
-                # Both are possible (or at least one is unknown)
-                newsched = list(cursched)
-                if canTrue == z3.sat:
-                    cursched.append(SchedNode("branch_nondet", self, True))
-                elif canTrue == z3.unknown:
-                    cursched.append(
-                        SchedNode("exception", True,
-                                  UncheckableConstraintError(
-                                      self._v, canTrueReason)))
+                if options.concolic:
+                    nodes = self.__explore_concolic(oracle)
                 else:
-                    assert canTrue == z3.unsat and canFalse == z3.unknown
-                    # There's actually only one way to go
-                    newsched = cursched
-
-                if canFalse == z3.sat:
-                    newsched.append(SchedNode("branch_nondet", self, False))
-                elif canFalse == z3.unknown:
-                    newsched.append(
-                        SchedNode("exception", False,
-                                  UncheckableConstraintError(
-                                      z3.Not(self._v), canFalseReason)))
-                else:
-                    assert canFalse == z3.unsat and canTrue == z3.unknown
-                    newsched = cursched
-
-                if newsched is not cursched:
-                    scheduler.queue_schedule(newsched)
+                    nodes = self.__explore(oracle)
+                if len(nodes) > 1 and options.max_path_depth is not None \
+                   and path_state.depth() >= options.max_path_depth:
+                    if nodes[1].typ == "branch_unchecked":
+                        # The model decided this branch, which may
+                        # really be deterministic.  Only end the path
+                        # at a branch that forks.
+                        try:
+                            path_state.resolve(nodes[1])
+                        except InfeasibleBranch:
+                            nodes = [SchedNode("branch_det", self,
+                                               nodes[0].val)]
+                    if len(nodes) > 1:
+                        # End the path here rather than forking again
+                        nodes = [SchedNode("exception", True,
+                                           PathDepthExceeded(
+                                               self._v,
+                                               options.max_path_depth))]
+                scheduler.branch(path_state, nodes)
         else:
             # We're replaying; check that replay hasn't diverged
             node = cursched[path_state.schedidx]
@@ -552,9 +822,19 @@ class SBool(SExpr, SymbolicConst):
 
         # Follow the schedule (which we may have just extended)
         node = cursched[path_state.schedidx]
+        if node.typ == "branch_unchecked":
+            # We've replayed up to a queued concolic alternative
+            try:
+                path_state.resolve(node)
+            except InfeasibleBranch:
+                # Drop the node, so code that runs as the path unwinds
+                # (such as a finally clause recording a note) extends
+                # the schedule instead of diverging from it
+                del cursched[path_state.schedidx:]
+                raise
         path_state.schedidx += 1
         if node.is_branch():
-            solver.add(unwrap(node.path_expr()))
+            oracle.add(unwrap(node.path_expr()))
             return node.val
         elif node.typ == "exception":
             raise node.val
@@ -566,14 +846,29 @@ class SUninterpretedBase(SExpr):
 
 
 # ckx: 符号化变量类
-def tuninterpreted(name):
+# Map from the Z3 sorts of finite uninterpreted types to their values
+_finite_domains = {}
+# Release the Z3 sorts and values while the z3 module is still intact
+atexit.register(_finite_domains.clear)
+
+def tuninterpreted(name, bound=None):
     """Return a new uninterpreted symbolic type.
 
     This type is inhabited by an unbounded number of distinct
-    constants.
+    constants.  bound, if not None, is the most distinct values of
+    this type a test case can use (usually the size of the test
+    generator's pool for it).  If options.finite_domains is set, a
+    type with a bound is instead inhabited by exactly that many
+    distinct constants, so quantifiers over it can be expanded.
     """
+    if bound is not None and options.finite_domains:
+        sort, vals = z3.EnumSort(
+            name, ["%s!val!%d" % (name, i) for i in range(bound)])
+        _finite_domains[sort] = vals
+    else:
+        sort = z3.DeclareSort(name)
     return type(name, (SUninterpretedBase, SymbolicConst),
-                {"__z3_sort__": z3.DeclareSort(name)})
+                {"__z3_sort__": sort})
 
 class SEnumBase(SExpr):
     __ref_type__ = z3.DatatypeRef
@@ -656,6 +951,61 @@ def tsynonym(name, baseType):
 # Compound objects
 #
 
+def _is_value(z3expr):
+    """Return True if z3expr is a literal value.
+
+    Distinct literal values of the same sort are never equal.
+    """
+    return z3.is_int_value(z3expr) or z3.is_true(z3expr) or \
+        z3.is_false(z3expr) or \
+        (z3.is_const(z3expr) and
+         z3expr.decl().kind() == z3.Z3_OP_DT_CONSTRUCTOR)
+
+def _store_writes(z3map):
+    """Split a chain of Z3 Stores into its base array and its writes.
+
+    Returns (base, writes), where writes is a list of (index, value)
+    pairs from the oldest write to the newest.
+    """
+    writes = []
+    while z3.is_store(z3map):
+        z3map, idx, val = z3map.children()
+        writes.append((idx, val))
+    writes.reverse()
+    return z3map, writes
+
+def _select(z3map, z3idx):
+    """Return a Z3 expression for z3map[z3idx].
+
+    This answers reads at an index that was written at a syntactically
+    identical index directly from the Store chain, skipping writes to
+    indexes that are certainly different.
+    """
+    arr = z3map
+    while z3.is_store(arr):
+        inner, widx, wval = arr.children()
+        if widx.eq(z3idx):
+            return wval
+        if not (_is_value(widx) and _is_value(z3idx)):
+            break
+        arr = inner
+    return z3.Select(arr, z3idx)
+
+def _store(z3map, z3idx, z3val):
+    """Return a Z3 array equal to z3map with z3idx mapped to z3val.
+
+    Any earlier write to a syntactically identical index is dropped
+    from the Store chain, so the chain has one write per distinct
+    index no matter how many times each index is assigned.
+    """
+    base, writes = _store_writes(z3map)
+    if not any(widx.eq(z3idx) for widx, _ in writes):
+        return z3.Store(z3map, z3idx, z3val)
+    for widx, wval in writes:
+        if not widx.eq(z3idx):
+            base = z3.Store(base, widx, wval)
+    return z3.Store(base, z3idx, z3val)
+
 class SMapBase(Symbolic):
     """The base type of symbolic mutable mapping types.  Objects of
     this type map from symbolic values to symbolic values.  Maps
@@ -690,6 +1040,10 @@ class SMapBase(Symbolic):
     def _eq_internal(self, o):
         if type(self) != type(o):
             return NotImplemented
+        written = self._written_indexes(o)
+        if written is not None:
+            # The maps can only differ where they were written
+            return symand([self[idx] == o[idx] for idx in written])
         if isinstance(self._valueType, SExpr):
             # Optimize away the forall
             vs, vo = self._getter(), o._getter()
@@ -702,26 +1056,49 @@ class SMapBase(Symbolic):
         x = self._indexType.var()
         return forall(x, self[x] == o[x])
 
+    def _written_indexes(self, o):
+        """Return the indexes at which self and o may differ.
+
+        If each of the component arrays of self and o is a chain of
+        Stores over the same base array, returns a list of the indexes
+        written in either map.  Otherwise, returns None.
+        """
+        indexes, seen = [], z3util.AstSet()
+        for a, b in zip(flatten_compound(self._getter()),
+                        flatten_compound(o._getter())):
+            abase, awrites = _store_writes(a)
+            bbase, bwrites = _store_writes(b)
+            if not abase.eq(bbase):
+                return None
+            for idx, _ in awrites + bwrites:
+                if idx not in seen:
+                    seen.add(idx)
+                    indexes.append(self._indexType._wrap(idx, None))
+        return indexes
+
+    def __z3_index(self, idx):
+        return self._indexType._z3_sort().cast(unwrap(idx))
+
     def __getitem__(self, idx):
         """Return the value at index 'idx'."""
-        z3idx = unwrap(idx)
+        z3idx = self.__z3_index(idx)
         return self._valueType._wrap_lvalue(
             lambda: compound_map(
-                lambda z3val: z3.Select(z3val, z3idx), self._getter()),
+                lambda z3val: _select(z3val, z3idx), self._getter()),
             lambda val: self.__setitem__(idx, val),
             self._model)
 
     def __setitem__(self, idx, val):
         """Change the value at index 'idx'."""
-        z3idx = unwrap(idx)
+        z3idx = self.__z3_index(idx)
         def set1(z3map, z3val):
             # If we have an array of structs, assigning to a single
             # struct field will cause an identity update of all of the
             # other fields.  Avoid building up huge, pointless Store
             # expressions.
-            if z3.is_ast(z3val) and z3map[z3idx].eq(z3val):
+            if z3.is_ast(z3val) and _select(z3map, z3idx).eq(z3val):
                 return z3map
-            return z3.Store(z3map, z3idx, z3val)
+            return _store(z3map, z3idx, z3val)
         self._setter(compound_map(set1, self._getter(), unwrap(val)))
 
 def tmap(indexType, valueType):
@@ -740,10 +1117,35 @@ def tmap(indexType, valueType):
                 {"_indexType" : indexType, "_valueType" : valueType,
                  "__z3_sort__" : sort})
 
+# If not None, a (cell, names) pair set by track_field_reads.
+_field_reads = None
+
+def track_field_reads(struct, names=None):
+    """Record the top-level fields of struct that are read.
+
+    Until the next call, every field of struct fetched by attribute
+    access adds its name to the set names.  struct must be stored in
+    a cell, like the result of var.  Pass None to stop tracking.
+    """
+    global _field_reads
+    if struct is None:
+        _field_reads = None
+    else:
+        assert struct._cell is not None and struct._offset == 0
+        _field_reads = (struct._cell, names)
+
 class SStructBase(Symbolic):
     """The base type of symbolic mutable structure types.  Structure
     types have a fixed set of named fields, where the fields may have
-    different symbolic types."""
+    different symbolic types.
+
+    Structs created as lvalues store their compound value as a flat
+    list of leafs in a _Cell, in the order given by the type's _shape.
+    Struct fields are views of a range of the same cell, and copying
+    a whole struct snapshots the cell without copying it.  Structs
+    wrapped around a getter and setter (such as map elements) instead
+    fetch and update their compound value through these.
+    """
 
     @classmethod
     def var(cls, __name=None, __model=None, **fields):
@@ -778,6 +1180,13 @@ class SStructBase(Symbolic):
             raise AttributeError("Unknown struct field %r" % fields.keys()[0])
         return cls._new_lvalue(z3_val, __model)
 
+    @classmethod
+    def _new_lvalue(cls, init, model):
+        obj = cls._wrap_cell(_Cell(flatten_shaped(cls._shape, init)), 0, model)
+        if model is None:
+            obj._declare_assumptions(assume)
+        return obj
+
     @classmethod
     def _wrap_lvalue(cls, getter, setter, model):
         obj = cls.__new__(cls)
@@ -785,10 +1194,50 @@ class SStructBase(Symbolic):
         object.__setattr__(obj, "_getter", getter)
         object.__setattr__(obj, "_setter", setter)
         object.__setattr__(obj, "_model", model)
+        object.__setattr__(obj, "_cell", None)
+        return obj
+
+    @classmethod
+    def _wrap_cell(cls, cell, offset, model):
+        """Return an instance of this class stored in cell.
+
+        The instance's leafs are the _width leafs of cell starting at
+        offset.  Struct-typed fields of the returned instance share
+        the cell, so field reads and writes don't go through any
+        getters or setters.
+        """
+        obj = cls.__new__(cls)
+        object.__setattr__(obj, "_cell", cell)
+        object.__setattr__(obj, "_offset", offset)
+        object.__setattr__(obj, "_model", model)
         return obj
 
     def _z3_value(self):
-        return self._getter()
+        if self._cell is None:
+            return self._getter()
+        leafs = itertools.islice(self._cell.leafs, self._offset,
+                                 self._offset + self._width)
+        return unflatten_shaped(self._shape, leafs)
+
+    def copy(self):
+        if self._cell is None:
+            return super(SStructBase, self).copy()
+        if self._offset == 0 and self._width == len(self._cell.leafs):
+            return self._wrap_cell(self._cell.snapshot(), 0, MODEL_FETCH)
+        return self.bind(MODEL_FETCH)
+
+    def _set_z3_value(self, val):
+        """Replace the compound Z3 value of this struct with val."""
+        if self._cell is None:
+            self._setter(val)
+        else:
+            self._cell.set(self._offset, flatten_shaped(self._shape, val))
+
+    def bind(self, model):
+        if self._cell is None:
+            return super(SStructBase, self).bind(model)
+        leafs = self._cell.leafs[self._offset:self._offset + self._width]
+        return self._wrap_cell(_Cell(leafs), 0, model)
 
     def _declare_assumptions(self, assume):
         super(SStructBase, self)._declare_assumptions(assume)
@@ -801,22 +1250,65 @@ class SStructBase(Symbolic):
         if type(self) != type(o):
             return NotImplemented
         return symand([getattr(self, name) == getattr(o, name)
-                       for name in self._fields])
+                       for name in self._written_fields(o)])
+
+    def _written_fields(self, o):
+        """Return the names of the fields that may differ in self and o.
+
+        If both structs are stored in cells and structural equality
+        elimination is enabled, fields whose leafs are identical in
+        self and o are omitted.  States copied from a common initial
+        state share the leafs of every field neither has written, so
+        comparing them only touches the union of their write sets.
+        """
+        if not options.eq_eliminate_structural or \
+           self._cell is None or o._cell is None:
+            return self._fields.keys()
+        sleafs, oleafs = self._cell.leafs, o._cell.leafs
+        soff, ooff = self._offset, o._offset
+        res = []
+        for name in self._fields:
+            start, end, _ = self._field_slots[name]
+            for i in xrange(start, end):
+                a, b = sleafs[soff + i], oleafs[ooff + i]
+                if a is not b and not _same_leaf(a, b):
+                    res.append(name)
+                    break
+        return res
 
     def __getattr__(self, name):
         if name not in self._fields:
             raise AttributeError(name)
-        return self._fields[name]._wrap_lvalue(
-            lambda: self._getter()[name],
-            lambda val: self.__setattr__(name, val),
+        ftype = self._fields[name]
+        if _field_reads is not None and self._cell is _field_reads[0] \
+           and self._offset == 0:
+            _field_reads[1].add(name)
+        if self._cell is None:
+            return ftype._wrap_lvalue(
+                lambda: self._getter()[name],
+                lambda val: self.__setattr__(name, val),
+                self._model)
+
+        start, end, fshape = self._field_slots[name]
+        cell, start, end = self._cell, self._offset + start, self._offset + end
+        if issubclass(ftype, SStructBase):
+            return ftype._wrap_cell(cell, start, self._model)
+        return ftype._wrap_lvalue(
+            lambda: unflatten_shaped(
+                fshape, itertools.islice(cell.leafs, start, end)),
+            lambda val: cell.set(start, flatten_shaped(fshape, unwrap(val))),
             self._model)
 
     def __setattr__(self, name, val):
         if name not in self._fields:
             raise AttributeError(name)
-        cval = self._getter()
-        cval[name] = unwrap(val)
-        self._setter(cval)
+        if self._cell is None:
+            cval = self._getter()
+            cval[name] = unwrap(val)
+            self._setter(cval)
+            return
+        start, _, fshape = self._field_slots[name]
+        self._cell.set(self._offset + start, flatten_shaped(fshape, unwrap(val)))
 #ckx: 符号变量变化的方法
 def tstruct(**fields):
     """Return a subclass of SStructBase for a struct type with the
@@ -825,7 +1317,17 @@ def tstruct(**fields):
 
     name = "SStruct_" + "_".join(fields.keys())
     sort = {fname: typ._z3_sort() for fname, typ in fields.items()}
-    type_fields = {"__slots__": [], "_fields": fields, "__z3_sort__": sort}
+    # Struct values are stored as flat lists of leafs.  Precompute the
+    # [start, end) range and shape of each field in this list.
+    shape = compound_shape(sort)
+    field_slots, width = {}, 0
+    for fname, fshape in shape:
+        fwidth = shape_width(fshape)
+        field_slots[fname] = (width, width + fwidth, fshape)
+        width += fwidth
+    type_fields = {"__slots__": [], "_fields": fields, "__z3_sort__": sort,
+                   "_shape": shape, "_field_slots": field_slots,
+                   "_width": width}
     return type(name, (SStructBase,), type_fields)
 
 #
@@ -905,7 +1407,8 @@ def exists(vars, e, patterns=[]):
             raise TypeError("exists variable must be symbolic")
     if len(z3vars) == 0:
         return e
-    return wrap(z3.Exists(z3vars, unwrap(e), patterns=map(unwrap, patterns)))
+    return wrap(_quantify(z3.Exists, z3.Or, z3vars, unwrap(e),
+                          map(unwrap, patterns)))
 
 def forall(vars, e, patterns=[]):
     if not isinstance(vars, (list, tuple)):
@@ -922,7 +1425,26 @@ def forall(vars, e, patterns=[]):
             raise TypeError("forall variable must be symbolic")
     if len(z3vars) == 0:
         return e
-    return wrap(z3.ForAll(z3vars, unwrap(e), patterns=map(unwrap, patterns)))
+    return wrap(_quantify(z3.ForAll, z3.And, z3vars, unwrap(e),
+                          map(unwrap, patterns)))
+
+def _quantify(quantifier, join, z3vars, body, patterns):
+    """Bind z3vars in body using quantifier.
+
+    Variables of finite uninterpreted types (see tuninterpreted) are
+    eliminated by substituting every combination of their values into
+    body and combining the instances with join.  Any other variables
+    remain bound by quantifier.
+    """
+    finite = [v for v in z3vars if v.sort() in _finite_domains]
+    if finite:
+        z3vars = [v for v in z3vars if v.sort() not in _finite_domains]
+        domains = [_finite_domains[v.sort()] for v in finite]
+        body = join([z3.substitute(body, *zip(finite, vals))
+                     for vals in itertools.product(*domains)])
+        if not z3vars:
+            return body
+    return quantifier(z3vars, body, patterns=patterns)
 
 #
 # Conversions to Z3 types and wrapper types
@@ -1009,58 +1531,211 @@ def ast_cleanup(a):
 # Execution graph visualization
 #
 
-class SchedGraph(graph.Graph):
-    def __init__(self):
-        super(SchedGraph, self).__init__()
-        self.node_attrs(shape="box")
-        # SchedNodes are graph *edges*.  When the schedule forks,
-        # we'll get two SchedNodes with identical metadata but
-        # different vals.  For each graph node, we pick the first edge
-        # out of it we see to represent that graph node and we
-        # identify it by its predecessor SchedNode (which can be
-        # thought of as the edge tail going in to the graph node).
-        self.__tail_to_gnode = {}
+def _sched_node_label(snode):
+    """Return the execution graph label for SchedNode snode."""
+    parts = []
+    if snode.expr is not None:
+        parts.append(str(z3.simplify(unwrap(snode.expr))))
+    parts.append("%s:%s" % (os.path.basename(snode.frames[0].filename),
+                            snode.frames[0].lineno))
+    return _trim_label("\n".join(parts))
+
+def _trim_label(label):
+    if len(label.splitlines()) > 10:
+        lines = label.splitlines()
+        lines = lines[:5] + [".. %d more lines .." % (len(lines) - 9)] + lines[-4:]
+        label = "\n".join(lines)
+    return label
+
+class SchedGraphRecorder(object):
+    """Streams the execution graphs of symbolic_apply to a file.
+
+    fmt is either "dot", in which case fp receives a single DOT graph
+    with a cluster for each symbolic_apply, or "jsonl", in which case
+    fp receives one JSON record per line for each application, node,
+    edge, and result.  If sample is greater than 1, only every
+    sample'th path of each application is recorded.
+
+    Assumptions and non-deterministic branches become graph nodes.
+    Each node is identified by the decisions that lead to it, and only
+    the part of each path that differs from the last recorded path is
+    written, so the recorder's memory is bounded by the path depth.
+    When paths are sampled or explored in an order other than depth
+    first, this may write some nodes and edges more than once.
+    """
+
+    def __init__(self, fp, fmt="dot", sample=1):
+        if fmt not in ("dot", "jsonl"):
+            raise ValueError("Unknown execution graph format %r" % fmt)
+        self.__fp, self.__fmt, self.__sample = fp, fmt, sample
+        self.__napply = self.__npath = 0
+        # (node ID, edge label) for each node of the last recorded path
+        self.__last = []
+        if fmt == "dot":
+            print >>self.__fp, "digraph G {"
+            print >>self.__fp, "node %s;" % graph.dot_attrs({"shape": "box"})
+
+    def close(self):
+        if self.__fmt == "dot":
+            print >>self.__fp, "}"
+        self.__fp.close()
+
+    def __write(self, typ, nid, label, **attrs):
+        if self.__fmt == "jsonl":
+            attrs.update(type=typ, apply=self.__napply, id=nid, label=label)
+            print >>self.__fp, json.dumps(attrs)
+        elif typ == "edge":
+            attrs["label"] = label
+            print >>self.__fp, "%s -> %s %s;" % (nid, attrs.pop("dst"),
+                                                 graph.dot_attrs(attrs))
+        else:
+            attrs["label"] = label
+            print >>self.__fp, "%s %s;" % (nid, graph.dot_attrs(attrs))
+
+    def begin_apply(self, label):
+        """Begin the execution graph of a new symbolic_apply."""
+        self.__napply += 1
+        self.__npath = 0
+        self.__last = []
+        if self.__fmt == "dot":
+            print >>self.__fp, "subgraph cluster_%d {" % self.__napply
+            print >>self.__fp, "graph %s;" % graph.dot_attrs({"label": label})
+        else:
+            self.__write("apply", self.__napply, label)
+
+    def end_apply(self):
+        """End the execution graph of the current symbolic_apply."""
+        if self.__fmt == "dot":
+            print >>self.__fp, "}"
+        self.__fp.flush()
+
+    def next_path(self):
+        """Return True if the next path should be recorded."""
+        self.__npath += 1
+        return (self.__npath - 1) % self.__sample == 0
 
     def add_sched(self, sched, result, result_color=None):
-        prev_snode = None
-        path = []
-        for snode in sched:
+        """Record the schedule of a path that ended with result."""
+
+        path, bits = [], ""
+        for idx, snode in enumerate(sched):
             if snode.typ in ("assumption", "branch_nondet"):
-                gnode = self.__tail_to_gnode.get(prev_snode)
-                if gnode is None:
-                    gnode = self.__tail_to_gnode[prev_snode] = self.node(snode)
+                nid = "a%d_%s_%d" % (self.__napply, bits, idx)
+                label = None
                 if snode.typ == "branch_nondet":
-                    edge_attrs = {"label": str(snode.val)[0]}
-                else:
-                    edge_attrs = {}
-                path.append((gnode, edge_attrs))
-            prev_snode = snode
-        path.append((self.node(result, unique=True, color=result_color), {}))
-        for (n1, attrs), (n2, _) in zip(path, path[1:]):
-            self.edge(n1, n2, **attrs)
-
-    def obj_attrs(self, node):
-        if isinstance(node, SchedNode):
-            parts = []
-            if node.expr is not None:
-                parts.append(str(z3.simplify(unwrap(node.expr))))
-            parts.append("%s:%s" % (os.path.basename(node.frames[0].filename),
-                                    node.frames[0].lineno))
-            label = "\n".join(parts)
-        else:
-            label = str(node)
+                    label = str(snode.val)[0]
+                path.append((nid, label, snode))
+            if snode.typ == "branch_nondet":
+                bits += str(int(snode.val))
+        rid = "a%d_r%d" % (self.__napply, self.__npath)
+
+        last = self.__last
+        for i, (nid, label, snode) in enumerate(path):
+            if i >= len(last) or last[i][0] != nid:
+                self.__write("node", nid, _sched_node_label(snode))
+        self.__write("result", rid, _trim_label(result), color=result_color)
+        dsts = [nid for nid, _, _ in path[1:]] + [rid]
+        for i, ((nid, label, _), dst) in enumerate(zip(path, dsts)):
+            if i + 1 < len(last) and last[i] == (nid, label) and \
+               last[i + 1][0] == dst:
+                continue
+            self.__write("edge", nid, label, dst=dst)
+        self.__last = [(nid, label) for nid, label, _ in path]
+
+_sched_graph = None
 
-        # Trim label
-        if len(label.splitlines()) > 10:
-            lines = label.splitlines()
-            lines = lines[:5] + [".. %d more lines .." % (len(lines) - 9)] + lines[-4:]
-            label = "\n".join(lines)
-        return {"label": label}
+def _sched_graph_recorder():
+    """Return the SchedGraphRecorder for options.sched_graph_file.
+
+    Returns None if execution graph recording is disabled.
+    """
+    global _sched_graph
+    if options.sched_graph_file is None:
+        return None
+    if _sched_graph is None:
+        fmt = "jsonl" if options.sched_graph_file.endswith(".jsonl") else "dot"
+        _sched_graph = SchedGraphRecorder(
+            open(options.sched_graph_file, "w"), fmt,
+            options.sched_graph_sample)
+        atexit.register(_sched_graph.close)
+    return _sched_graph
 
 #
 # Symbolic executor
 #
 
+class LayeredMap(object):
+    """A dictionary with O(1) copies.
+
+    A LayeredMap consists of a private dictionary of recent updates on
+    top of a chain of frozen layers that may be shared with other
+    LayeredMaps.  Copying a LayeredMap freezes its private dictionary
+    into a new shared layer, so the original and the copy share all
+    of their entries and each records later updates privately.
+    Lookups walk the chain from the top, so copies compact the chain
+    into a single layer once it grows deeper than max_depth.
+
+    This supports the subset of the dict interface that Env needs.
+    """
+
+    __slots__ = ["__local", "__layers"]
+
+    max_depth = 8
+
+    def __init__(self):
+        self.__local = {}
+        # Tuple of frozen dictionaries, from newest to oldest
+        self.__layers = ()
+
+    def copy(self):
+        if self.__local:
+            layers = (self.__local,) + self.__layers
+            if len(layers) > self.max_depth:
+                flat = {}
+                for layer in reversed(layers):
+                    flat.update(layer)
+                layers = (flat,)
+            self.__layers = layers
+            self.__local = {}
+        res = LayeredMap()
+        res.__layers = self.__layers
+        return res
+
+    def __getitem__(self, key):
+        if key in self.__local:
+            return self.__local[key]
+        for layer in self.__layers:
+            if key in layer:
+                return layer[key]
+        raise KeyError(key)
+
+    def __setitem__(self, key, value):
+        self.__local[key] = value
+
+    def __contains__(self, key):
+        return key in self.__local or \
+            any(key in layer for layer in self.__layers)
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def iteritems(self):
+        seen = set()
+        for layer in (self.__local,) + self.__layers:
+            for key, value in layer.iteritems():
+                if key not in seen:
+                    seen.add(key)
+                    yield key, value
+
+    def __iter__(self):
+        return (key for key, _ in self.iteritems())
+
+    def __len__(self):
+        return sum(1 for _ in self.iteritems())
+
 class Env(object):
     """Execution environment.
 
@@ -1078,11 +1753,16 @@ class Env(object):
         # instance constructors.  Each instance constructor must take
         # two arguments: the user variable name and a simsym.Model
         # object that binds the Z3 environment.
-        self.var_constructors = parent.var_constructors.copy() if parent else {}
+        # This and const_types are LayeredMaps, so creating an Env is
+        # O(1) and SymbolicApplyResults share the declarations their
+        # paths have in common.
+        self.var_constructors = parent.var_constructors.copy() \
+                                if parent else LayeredMap()
 
         # Map from Z3 constant names to (outer Symbolic type, compound
         # path)
-        self.const_types = parent.const_types.copy() if parent else {}
+        self.const_types = parent.const_types.copy() \
+                           if parent else LayeredMap()
 
         # Anonymous variable index.  It's important that each code
         # path start with the same anonymous index to make replay
@@ -1130,6 +1810,11 @@ class SchedNode(object):
     - "branch_nondet" for a non-deterministic branch.  val must be
       True or False.
 
+    - "branch_unchecked" for a side of a branch that has not been
+      checked for feasibility (see options.concolic).  val must be
+      True or False.  Following this node checks it and turns it into
+      a "branch_nondet" or "exception" node (see PathState.resolve).
+
     - "branch_det" for a deterministic branch.  val must be True or
       False.  These are recorded for replay purposes; if we didn't
       record these, we would have to invoke the solver on every branch
@@ -1146,17 +1831,27 @@ class SchedNode(object):
     - "note" for a user-defined schedule note.  expr must be None.
       val must be the note.
 
-    In all cases except "exception", expr is the Symbolic expression
-    that must be equal to val to follow this schedule step.
+    - "merge" for a call explored by merge_call.  expr must be None.
+      val must be the list of the call's paths, each given as the
+      decisions that lead to it, or None if the call could not be
+      merged.
+
+    In all cases except "exception", "note", and "merge", expr is the
+    Symbolic expression that must be equal to val to follow this
+    schedule step.
     """
 
     def __init__(self, typ, expr, val):
-        if typ not in ("branch_nondet", "branch_det", "exception",
-                       "assumption", "note"):
+        if typ not in ("branch_nondet", "branch_unchecked", "branch_det",
+                       "exception", "assumption", "note", "merge"):
             raise ValueError("Bad SchedNode type %r" % typ)
         self.typ = typ
         self.expr = expr
         self.val = val
+        # True for a branch_nondet node that options.concolic took
+        # because it holds in a model, before the other side was
+        # checked.  The other side may turn out to be infeasible.
+        self.model_decided = False
 
         # Unwind out of this module and record the call stack
         frames = [inspect.getframeinfo(frrec[0], 3)
@@ -1170,7 +1865,44 @@ class SchedNode(object):
         return "SchedNode(%r, %r, %r)" % (self.typ, self.expr, self.val)
 
     def is_branch(self):
-        return self.typ == "branch_nondet" or self.typ == "branch_det"
+        return self.typ in ("branch_nondet", "branch_unchecked", "branch_det")
+
+    def decision(self):
+        """Return a picklable description of the decision this node makes.
+
+        For branch and exception nodes, SchedNode.from_decision can
+        reconstruct an equivalent node from this description and the
+        branch's expression.
+        """
+        if self.typ == "exception":
+            depth = None
+            if isinstance(self.val, PathDepthExceeded):
+                depth = self.val.depth
+            return (self.typ, self.expr, str(self.val), depth)
+        if self.model_decided:
+            return (self.typ, self.val, "model")
+        return (self.typ, self.val)
+
+    @classmethod
+    def from_decision(cls, decision, expr):
+        """Construct a branch or exception node from a decision.
+
+        decision must have been returned by SchedNode.decision for a
+        branch on expr.
+        """
+        if decision[0] == "exception":
+            if decision[3] is not None:
+                return cls("exception", decision[1],
+                           PathDepthExceeded(unwrap(expr), decision[3]))
+            z3expr = unwrap(expr) if decision[1] else z3.Not(unwrap(expr))
+            return cls("exception", decision[1],
+                       UncheckableConstraintError(z3expr, decision[2]))
+        if decision[0] not in ("branch_nondet", "branch_unchecked",
+                               "branch_det"):
+            raise ReplayDivergedError(decision, "branch")
+        node = cls(decision[0], expr, decision[1])
+        node.model_decided = decision[2:] == ("model",)
+        return node
 
     def path_expr(self):
         """Return the path condition expression for this node."""
@@ -1181,12 +1913,27 @@ class SchedNode(object):
         raise ValueError("No path expression for %r" % self)
 
 class Scheduler(object):
-    """Tracks the schedule for the current symbolic apply."""
+    """Tracks the schedule for the current symbolic apply.
 
-    def __init__(self):
-        # Stack of schedules; each schedule is a list of SchedNodes
+    strategy selects the order in which queued schedules are
+    explored.  It must be one of the names in Scheduler.strategies,
+    each of which corresponds to a _select_<name> method returning the
+    index in schedq of the next schedule to explore.  Subclasses may
+    add strategies by defining more _select_ methods.
+    """
+
+    strategies = ("dfs", "bfs", "random", "shortest")
+
+    def __init__(self, strategy="dfs"):
+        # Queue of schedules; each schedule is a list of SchedNodes
         self.schedq = []
 
+        select = getattr(self, "_select_" + strategy, None)
+        if select is None:
+            raise ValueError("Unknown search strategy %r" % strategy)
+        self.__select = select
+        self.__rng = random.Random(options.search_seed)
+
         # Prime the schedule
         self.queue_schedule([])
 
@@ -1195,15 +1942,689 @@ class Scheduler(object):
 
     def schedule_generator(self):
         while len(self.schedq) > 0:
-            yield self.schedq.pop()
+            yield self.schedq.pop(self.__select())
+
+    def _select_dfs(self):
+        """Explore the most recently queued schedule first."""
+        return len(self.schedq) - 1
+
+    def _select_bfs(self):
+        """Explore the least recently queued schedule first."""
+        return 0
+
+    def _select_random(self):
+        """Explore a random queued schedule."""
+        return self.__rng.randrange(len(self.schedq))
+
+    def _select_shortest(self):
+        """Explore the schedule with the shortest pathid first.
+
+        Ties go to the most recently queued schedule.
+        """
+        def key(i):
+            return (sum(1 for node in self.schedq[i]
+                        if node.typ in ("branch_nondet", "branch_unchecked",
+                                        "exception")), -i)
+        return min(xrange(len(self.schedq)), key=key)
+
+    def branch(self, path_state, nodes):
+        """Extend the current schedule at a branch.
+
+        nodes is a non-empty list of SchedNodes for the feasible
+        sides of the branch.  The current path follows nodes[0]; the
+        others are queued as new schedules to be replayed later.
+        """
+        for node in nodes[1:]:
+            self.queue_schedule(path_state.sched + [node])
+        path_state.follow(nodes[0])
+
+class ForkScheduler(Scheduler):
+    """A Scheduler that explores branches in forked checkpoints.
+
+    Rather than queuing alternative schedules, this forks the process
+    at each non-deterministic branch.  The child follows the first
+    side of the branch while the parent waits; once the child has
+    finished, the parent resumes from the checkpoint and follows the
+    next side.  This visits paths in the same order as Scheduler.
+    Every process reports the decisions of the single path it
+    completes as a record on wfd.
+    """
+
+    def __init__(self, wfd):
+        super(ForkScheduler, self).__init__()
+        self.__wfd = wfd
+        self.__base = _work_counters()
+
+    def branch(self, path_state, nodes):
+        for node in nodes[:-1]:
+            sys.stdout.flush()
+            sys.stderr.flush()
+            pid = os.fork()
+            if pid == 0:
+                # Only count the work this process does from here on
+                self.__base = _work_counters()
+                path_state.follow(node)
+                return
+            _, status = os.waitpid(pid, 0)
+            if status:
+                self.send(("error", path_state.decisions + [node.decision()],
+                           "Checkpoint exited with status %d" % status))
+                os._exit(1)
+        path_state.follow(nodes[-1])
+
+    def send(self, record):
+        """Send a (type, decisions, detail) record to the parent.
+
+        This appends the work this process did to the record (see
+        _work_since).
+        """
+        record += (_work_since(self.__base),)
+        data = cPickle.dumps(record, cPickle.HIGHEST_PROTOCOL)
+        while data:
+            data = data[os.write(self.__wfd, data):]
+
+class PoolScheduler(Scheduler):
+    """A Scheduler that hands alternative schedules to a worker pool.
+
+    Instead of keeping alternative schedules in schedq, this sends
+    each one to the calling process as a ("queue", decisions) record
+    on results, where decisions is the list of decisions that leads
+    to the alternative.  The calling process queues it for whichever
+    worker is idle next.
+    """
+
+    def __init__(self, results):
+        super(PoolScheduler, self).__init__()
+        self.__results = results
+
+    def queue_schedule(self, s):
+        # Schedules are exchanged as decisions; see branch
+        pass
+
+    def branch(self, path_state, nodes):
+        for node in nodes[1:]:
+            self.__results.put(
+                ("queue", path_state.decisions + [node.decision()]))
+        path_state.follow(nodes[0])
+
+def _decision_order(decisions):
+    """Return a sort key giving the exploration order of decisions.
+
+    Sorting paths by this key visits them in the order Scheduler
+    explores them: at each branch, the true side (nodes[0] in
+    Scheduler.branch) and everything below it comes before the false
+    side.  Paths that share a prefix of decisions always make the same
+    kind of decision next, so only the side taken matters.
+    """
+    return tuple(int(d[0] in ("branch_nondet", "branch_unchecked",
+                              "exception") and not d[1])
+                 for d in decisions)
+
+def _model_frame():
+    """Return the innermost stack frame outside of this module."""
+    frame = sys._getframe(1)
+    while frame.f_back and \
+          frame.f_code.co_filename == _model_frame.__code__.co_filename:
+        frame = frame.f_back
+    return frame
+
+def _query_record(kind, start, result):
+    """Return a dict describing a query that began at time start."""
+    frame = _model_frame()
+    return dict(query_trace_info,
+                kind=kind, time=time.time() - start, result=str(result),
+                file=frame.f_code.co_filename, line=frame.f_lineno,
+                func=frame.f_code.co_name)
+
+class QueryTracer(object):
+    """Writes a JSON record for each solver query to a file.
+
+    Each record attributes the query to the innermost source line
+    outside of simsym, which is the model code that caused it (or,
+    for checks made by spec.py and friends, the caller).
+
+    fp should be opened for appending.  Each record is written with a
+    single write and flushed, so processes forked during a run can
+    trace to the same file without losing or interleaving records.
+    """
+
+    def __init__(self, fp):
+        self.__fp = fp
+
+    def close(self):
+        self.__fp.close()
+
+    def record(self, kind, start, result, expr=None, nassertions=None):
+        """Record a query of the given kind that began at time start.
+
+        expr, if not None, is the queried Z3 expression.  nassertions,
+        if not None, is the number of assertions in the solver.
+        """
+        rec = _query_record(kind, start, result)
+        if expr is not None:
+            rec["size"] = z3util.dag_size(expr)
+        if nassertions is not None:
+            rec["assertions"] = nassertions
+        self.__fp.write(json.dumps(rec) + "\n")
+        self.__fp.flush()
+
+_query_trace = None
+
+def _query_tracer():
+    """Return the QueryTracer for options.query_trace_file.
+
+    Returns None if query tracing is disabled.  Records are appended
+    to the file; the caller is responsible for truncating it before a
+    new run.
+    """
+    global _query_trace
+    if options.query_trace_file is None:
+        return None
+    if _query_trace is None:
+        _query_trace = QueryTracer(open(options.query_trace_file, "a"))
+        atexit.register(_query_trace.close)
+    return _query_trace
+
+class QueryDumper(object):
+    """Writes each solver query to a directory as an SMT-LIB2 file.
+
+    Files are named PID-N.smt2, so processes forked during a run (and
+    separate runs) can share a directory.  Each file is written
+    completely when its query finishes.
+    """
+
+    def __init__(self, directory):
+        try:
+            os.makedirs(directory)
+        except OSError:
+            # Another process may have created it
+            if not os.path.isdir(directory):
+                raise
+        self.__dir = directory
+        self.__count = itertools.count()
+
+    def dump(self, kind, start, result, assertions, assumptions=()):
+        """Write a query that began at time start.
+
+        The query is the conjunction of assertions and assumptions.
+        The first line of the file is a comment holding a JSON query
+        trace record; the rest can be given to z3 directly.
+        """
+        rec = _query_record(kind, start, result)
+        solver = z3.Solver()
+        solver.add(*assertions)
+        solver.add(*assumptions)
+        name = "%d-%d.smt2" % (os.getpid(), next(self.__count))
+        with open(os.path.join(self.__dir, name), "w") as fp:
+            print >>fp, "; query:", json.dumps(rec)
+            fp.write(solver.sexpr())
+            print >>fp, "(check-sat)"
+
+_query_dump = None
+
+def _query_dumper():
+    """Return the QueryDumper for options.query_dump_dir.
+
+    Returns None if query dumping is disabled.
+    """
+    global _query_dump
+    if options.query_dump_dir is None:
+        return None
+    if _query_dump is None:
+        _query_dump = QueryDumper(options.query_dump_dir)
+    return _query_dump
+
+def _new_solver(strategy="fresh"):
+    """Return a new solver for a portfolio strategy.
+
+    The solver is subject to options.solver_timeout.
+    """
+    if strategy.startswith("tactic:"):
+        solver = z3.Tactic(strategy[len("tactic:"):]).solver()
+    else:
+        solver = z3.Solver()
+        if strategy.startswith("seed:"):
+            solver.set("random_seed", int(strategy[len("seed:"):]))
+        elif strategy != "fresh":
+            raise ValueError("Unknown solver strategy %r" % strategy)
+    if options.solver_timeout is not None:
+        solver.set("timeout", int(options.solver_timeout * 1000))
+    return solver
+
+def _solver_result(solver, sat):
+    """Return the (result, extra) pair for a solver's check result.
+
+    extra is the model for a sat result, the reason for an unknown
+    result, and None otherwise.
+    """
+    if sat == z3.sat:
+        return sat, solver.model()
+    elif sat == z3.unknown:
+        reason = solver.reason_unknown()
+        if options.solver_timeout is not None and \
+           reason in ("timeout", "canceled"):
+            reason = "timeout after %gs" % options.solver_timeout
+        return sat, reason
+    return sat, None
+
+def _solve_with(strategy, assertions, assumptions=()):
+    """Check assertions under assumptions using a new solver.
+
+    Returns a (result, extra) pair (see _solver_result).
+    """
+    try:
+        solver = _new_solver(strategy)
+        solver.add(*assertions)
+        return _solver_result(solver, solver.check(*assumptions))
+    except z3.Z3Exception as e:
+        # Tactics fail on formulas outside their fragment
+        if not strategy.startswith("tactic:"):
+            raise
+        return z3.unknown, str(e)
+
+def _solve_portfolio(assertions, assumptions=()):
+    """Race the options.portfolio strategies on a query.
+
+    Each strategy runs in a forked process.  Returns a (result, extra)
+    pair (see _solver_result).  Models can't leave the process that
+    found them, so for a sat result, the winning strategy is run again
+    in this process to get its model.
+    """
+
+    sys.stdout.flush()
+    sys.stderr.flush()
+    procs = {}
+    for strategy in options.portfolio:
+        rfd, wfd = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            try:
+                os.close(rfd)
+                sat, extra = _solve_with(strategy, assertions, assumptions)
+                if sat != z3.unknown:
+                    extra = None
+                data = cPickle.dumps((str(sat), extra))
+                while data:
+                    data = data[os.write(wfd, data):]
+            finally:
+                os._exit(0)
+        os.close(wfd)
+        procs[rfd] = (pid, strategy)
+
+    winner, reasons = None, []
+    try:
+        while procs and winner is None:
+            ready, _, _ = select.select(list(procs), [], [])
+            for rfd in ready:
+                pid, strategy = procs.pop(rfd)
+                with os.fdopen(rfd, "rb") as f:
+                    data = f.read()
+                os.waitpid(pid, 0)
+                result, reason = cPickle.loads(data) if data \
+                                 else ("unknown", "solver process failed")
+                if result != "unknown":
+                    winner = (strategy, result)
+                    break
+                reasons.append("%s: %s" % (strategy, reason))
+    finally:
+        for rfd, (pid, _) in procs.items():
+            os.close(rfd)
+            try:
+                os.kill(pid, signal.SIGKILL)
+            except OSError:
+                pass
+            os.waitpid(pid, 0)
+
+    if winner is None:
+        return z3.unknown, "portfolio failed (%s)" % "; ".join(reasons)
+    if winner[1] == "unsat":
+        return z3.unsat, None
+    return _solve_with(winner[0], assertions, assumptions)
+
+def _conjunct_keys(expr):
+    """Return the top-level conjuncts of Z3 expression expr.
+
+    The result is a frozenset of z3util.HashableAsts suitable as a
+    QueryCache key.
+    """
+
+    if not z3.is_expr(expr):
+        expr = z3.BoolVal(expr)
+    keys, stack = set(), [expr]
+    while stack:
+        e = stack.pop()
+        if z3.is_and(e):
+            stack.extend(e.children())
+        elif not z3.is_true(e):
+            keys.add(z3util.HashableAst(e))
+    return frozenset(keys)
+
+class QueryCache(object):
+    """A bounded LRU cache of solver query results.
+
+    Queries are keyed by the set of their conjuncts, as returned by
+    _conjunct_keys.  Besides exact matches, the cache answers queries
+    the way KLEE's counterexample cache does: a query containing all
+    of the conjuncts of a cached unsat query is unsat, and a query
+    satisfied by a cached model is sat.  Unknown results are never
+    cached, since a later query may have more time or another
+    strategy to decide them.
+
+    To find these matches without scanning every entry, the cache
+    indexes the keys of its sat and unsat entries by conjunct.
+    """
+
+    # The number of cached models to try evaluating on a miss
+    max_model_tries = 16
+
+    def __init__(self):
+        # Map from key to (z3 result, model or None)
+        self.__entries = collections.OrderedDict()
+        # Maps from conjunct to the set of keys containing it, for
+        # sat and unsat entries
+        self.__sat_index, self.__unsat_index = {}, {}
+        # Map from key to its position in LRU order (larger is more
+        # recent)
+        self.__stamps = {}
+        self.__clock = 0
+        self.hits = self.misses = 0
+
+    def __len__(self):
+        return len(self.__entries)
+
+    def clear(self):
+        self.__entries.clear()
+        self.__sat_index.clear()
+        self.__unsat_index.clear()
+        self.__stamps.clear()
+
+    def __index_of(self, result):
+        if result == z3.sat:
+            return self.__sat_index
+        return self.__unsat_index
+
+    def __touch(self, key, res):
+        # Make key the most recently used entry
+        self.__entries.pop(key, None)
+        self.__entries[key] = res
+        self.__clock += 1
+        self.__stamps[key] = self.__clock
+
+    def __remove(self, key):
+        res = self.__entries.pop(key)
+        del self.__stamps[key]
+        index = self.__index_of(res[0])
+        for c in key:
+            keys = index[c]
+            keys.discard(key)
+            if not keys:
+                del index[c]
+
+    def __recent(self, keys):
+        return sorted(keys, key=self.__stamps.__getitem__, reverse=True)
+
+    def __match(self, key, reuse_models):
+        # Return the key of a cached entry that decides key, or None
+
+        # A cached unsat query whose conjuncts all appear in key
+        index = self.__unsat_index
+        counts = collections.Counter()
+        for c in key:
+            counts.update(index.get(c, ()))
+        unsat = [okey for okey, n in counts.iteritems() if n == len(okey)]
+        if unsat:
+            return self.__recent(unsat)[0]
+        if not reuse_models or not key:
+            return None
+
+        # A cached sat query with all of key's conjuncts.  Every such
+        # query has key's rarest conjunct, so only those are checked.
+        index = self.__sat_index
+        rarest = min((index.get(c, ()) for c in key), key=len)
+        if not rarest:
+            return None
+        supersets = [okey for okey in rarest if okey >= key]
+        if supersets:
+            return self.__recent(supersets)[0]
+
+        # A cached model that happens to satisfy key.  Models of
+        # queries that share key's rarest conjunct are the likeliest.
+        for okey in self.__recent(rarest)[:self.max_model_tries]:
+            model = self.__entries[okey][1]
+            if all(z3.is_true(model.evaluate(c.ast, model_completion=True))
+                   for c in key - okey):
+                return okey
+        return None
+
+    def lookup(self, key, reuse_models=True):
+        """Return the (result, extra) pair for key, or None.
+
+        extra is the model for a sat result and None otherwise.  If
+        reuse_models is False, a sat result is only returned for an
+        exact match.
+        """
+
+        if not options.query_cache_size:
+            return None
+
+        if key not in self.__entries:
+            key = self.__match(key, reuse_models)
+            if key is None:
+                self.misses += 1
+                return None
+        res = self.__entries[key]
+        self.__touch(key, res)
+        self.hits += 1
+        return res
+
+    def insert(self, key, result, extra):
+        """Record the result of solving key.
+
+        Unknown results are not recorded.
+        """
+
+        if not options.query_cache_size or result == z3.unknown:
+            return
+        if key in self.__entries:
+            self.__remove(key)
+        self.__touch(key, (result, extra))
+        index = self.__index_of(result)
+        for c in key:
+            index.setdefault(c, set()).add(key)
+        while len(self.__entries) > options.query_cache_size:
+            self.__remove(next(iter(self.__entries)))
+
+query_cache = QueryCache()
+# Release cached Z3 models while the z3 module is still intact
+atexit.register(query_cache.clear)
+
+class BranchOracle(object):
+    """Answers satisfiability queries for a code path.
+
+    The oracle wraps the path's incremental solver, which holds the
+    path condition so far.  Queries use assumption literals rather
+    than push/pop pairs, so the solver keeps what it learns between
+    queries; each literal is retired once its query is done.  The
+    oracle also keeps the most recent model of the path condition; if
+    that model already satisfies a queried expression, the oracle
+    answers without invoking the solver.  Otherwise it consults
+    query_cache before invoking the solver.
+    """
+
+    def __init__(self):
+        self.solver = _new_solver()
+        # A model satisfying the path condition, or None
+        self.model = None
+        # The conjuncts of the path condition
+        self.__conds = frozenset()
+        # The expressions added to the path condition, in order.
+        # Unlike the solver's assertions, these leave out the clauses
+        # of past queries.
+        self.__exprs = []
+        # (expr, model) pairs found by queries since the last add
+        self.__found = []
+        self.__nlits = 0
+
+    @staticmethod
+    def __satisfies(model, expr):
+        if model is None:
+            return False
+        return z3.is_true(model.evaluate(expr, model_completion=True))
+
+    def add(self, expr):
+        """Add Z3 expression expr to the path condition."""
+        self.solver.add(expr)
+        self.__exprs.append(expr)
+        self.__conds = self.__conds.union(_conjunct_keys(expr))
+        if not self.__satisfies(self.model, expr):
+            # Perhaps we just found a model for this side
+            self.model = None
+            for fexpr, fmodel in self.__found:
+                if fexpr.eq(expr):
+                    self.model = fmodel
+                    break
+        self.__found = []
+
+    def check(self, expr=None, retry=True, kind="branch"):
+        """Check Z3 expression expr together with the path condition.
+
+        If expr is None, this checks the path condition alone.
+        Returns the Z3 check result and the reason if it is unknown.
+        If retry is True, unknown results are retried in a fresh
+        solver.  kind describes the query in the query trace.
+        """
+
+        if expr is None:
+            if self.model is not None:
+                return z3.sat, None
+        elif self.__satisfies(self.model, expr):
+            return z3.sat, None
+
+        key = self.__conds
+        if expr is not None:
+            key = key.union(_conjunct_keys(expr))
+        cached = query_cache.lookup(key)
+        if cached is not None:
+            sat, extra = cached
+        else:
+            sat, extra = self.__solve(expr, retry, kind)
+            query_cache.insert(key, sat, extra)
+
+        if sat == z3.sat:
+            if expr is None:
+                self.model = extra
+            else:
+                self.__found.append((expr, extra))
+        elif sat == z3.unknown:
+            return sat, extra
+        return sat, None
+
+    def evaluate(self, expr):
+        """Return the value of Z3 boolean expr in a model of the path
+        condition, or None if the path condition has no known model."""
+        if self.model is None:
+            self.check()
+        if self.model is None:
+            return None
+        return z3.is_true(self.model.evaluate(expr, model_completion=True))
+
+    def __solve(self, expr, retry, kind):
+        # The query on its own, without the retired clauses the
+        # solver still holds
+        assertions, assumptions = list(self.__exprs), []
+        if expr is not None:
+            lit = z3.Bool("!lit%d" % self.__nlits)
+            self.__nlits += 1
+            clause = z3.Implies(lit, expr)
+            self.solver.add(clause)
+            assertions.append(clause)
+            assumptions.append(lit)
+
+        start = time.time()
+        res = _solver_result(self.solver, self.solver.check(*assumptions))
+        if res[0] == z3.unknown and retry:
+            # Incremental solving changes how Z3 "compiles" formulas,
+            # so it's possible it can solve it in isolation.
+            if options.portfolio:
+                res = _solve_portfolio(assertions, assumptions)
+            else:
+                res = _solve_with("fresh", assertions, assumptions)
+        stats.solver_time += time.time() - start
+        tracer = _query_tracer()
+        if tracer is not None:
+            tracer.record(kind, start, res[0], expr, len(assertions))
+        dumper = _query_dumper()
+        if dumper is not None:
+            dumper.dump(kind, start, res[0], assertions, assumptions)
+        if expr is not None:
+            # Retire the literal, which makes its clause true at the
+            # top level so Z3 can drop it rather than carry it into
+            # every later query
+            self.solver.add(z3.Not(lit))
+        return res
 
 class PathState(object):
     """Tracks state for the current symbolic execution code path."""
 
-    def __init__(self, sched):
+    def __init__(self, sched, plan=None, explore=True):
         self.sched = sched
         self.schedidx = 0
-        self.solver = z3.Solver()
+        self.oracle = BranchOracle()
+
+        # List of the decisions made each time this path extended its
+        # schedule, in order.  These are SchedNode.decision tuples for
+        # branches and ("implied",) or ("assumption", result, reason)
+        # for assumptions.  Together with the code being executed,
+        # this determines the path completely.
+        self.decisions = []
+
+        # Decisions to take instead of consulting the solver.  Once
+        # the plan runs out, the path continues exploring if explore
+        # is True.
+        self.__plan = plan or []
+        self.__explore = explore
+
+    def planned(self):
+        """Return the next planned decision or None to explore."""
+        if len(self.decisions) < len(self.__plan):
+            return self.__plan[len(self.decisions)]
+        if not self.__explore:
+            raise ReplayDivergedError("end of plan", "schedule extension")
+        return None
+
+    def follow(self, node):
+        """Extend the schedule with node and record its decision."""
+        if node.typ == "branch_unchecked":
+            self.resolve(node)
+        self.sched.append(node)
+        self.decisions.append(node.decision())
+
+    def resolve(self, node):
+        """Check the feasibility of a branch_unchecked node.
+
+        If its side of the branch is feasible, this turns node into a
+        branch_nondet node.  If the solver can't tell, this turns it
+        into an exception node.  If it is infeasible, this raises
+        InfeasibleBranch.
+        """
+        z3expr = unwrap(node.path_expr())
+        sat, reason = self.oracle.check(z3expr)
+        if sat == z3.unsat:
+            raise InfeasibleBranch()
+        elif sat == z3.sat:
+            node.typ = "branch_nondet"
+        else:
+            node.typ, node.expr, node.val = \
+                "exception", node.val, UncheckableConstraintError(z3expr, reason)
+
+    def depth(self):
+        """Return the number of non-deterministic branches so far.
+
+        Branches the model decided in concolic mode don't count, since
+        their other side may be infeasible.
+        """
+        return sum(1 for node in self.sched[:self.schedidx]
+                   if node.typ == "branch_nondet" and not node.model_decided)
 
     def str_path(self):
         """Return the current path constraint as a string."""
@@ -1212,6 +2633,8 @@ class PathState(object):
         for node in self.sched[:self.schedidx]:
             if node.typ in ("exception", "note"):
                 note = str(node.val)
+            elif node.typ == "merge":
+                note = "merged call (%d paths)" % len(node.val or [])
             else:
                 note = str(simplify(node.path_expr()))
                 #note = str(node.path_expr())
@@ -1236,29 +2659,90 @@ def note(note):
             raise ReplayDivergedError(node, "note")
     path_state.schedidx += 1
 
-def simplify(expr, try_harder=False):
+def sched_index():
+    """Return the current position in the current schedule.
+
+    This can be passed to branch_outcomes later on the same path.
+    """
+    return Env.path_state().schedidx
+
+def branch_outcomes(start):
+    """Return the branches taken since schedule position start.
+
+    The result is a tuple giving the side (True or False) of each
+    branch the current path has followed since start, in order.
+    """
+    path_state = Env.path_state()
+    nodes = path_state.sched[start:path_state.schedidx]
+    return tuple(node.val for node in nodes if node.is_branch())
+
+# Simplification tactics by profile, built on first use
+_simplify_tactics = {}
+# Release the cached tactics while the z3 module is still intact
+atexit.register(_simplify_tactics.clear)
+
+def _simplify_tactic(profile):
+    tactic = _simplify_tactics.get(profile)
+    if tactic is not None:
+        return tactic
+    rewrite = z3.With('simplify', expand_select_store=True,
+                      ite_extra_rules=True, expand_store_eq=True)
+    if profile == "fast":
+        tactic = z3.Then(rewrite, 'propagate-values')
+    else:
+        core_simplifier = 'ctx-simplify'
+        if profile == "harder":
+            ## ctx-solver-simplify is very slow; use the
+            ## faster but less powerful ctx-simplify.
+            core_simplifier = 'ctx-solver-simplify'
+        tactic = z3.Repeat(z3.Then(rewrite,
+                                   'propagate-values',
+                                   'ctx-simplify',
+                                   core_simplifier,
+                                   ))
+    _simplify_tactics[profile] = tactic
+    return tactic
+
+# LRU cache of simplify results, keyed by (HashableAst, profile)
+_simplify_cache = collections.OrderedDict()
+# Release cached Z3 ASTs while the z3 module is still intact
+atexit.register(_simplify_cache.clear)
+
+def simplify(expr, try_harder=False, fast=False):
+    """Return a simplified form of symbolic expression expr.
+
+    If try_harder is True, this uses the slow ctx-solver-simplify
+    tactic.  If fast is True, this only rewrites expr and propagates
+    values, which is enough to drop trivial conjuncts like x == x when
+    only the variables of the result matter.  Results are cached (see
+    options.simplify_cache_size).
+    """
+
     expr = unwrap(expr)
     if not z3.is_ast(expr):
         return expr
-    core_simplifier = 'ctx-simplify'
-    if try_harder:
-        ## ctx-solver-simplify is very slow; use the
-        ## faster but less powerful ctx-simplify.
-        core_simplifier = 'ctx-solver-simplify'
-    t = z3.Repeat(z3.Then(z3.With('simplify', expand_select_store=True,
-                                              ite_extra_rules=True,
-                                              expand_store_eq=True),
-                          'propagate-values',
-                          'ctx-simplify',
-                          core_simplifier,
-                          ))
-    subgoals = t(expr)
-    if len(subgoals[0]) == 0:
-        s = wrap(z3.BoolVal(True))
-    else:
-        s = wrap(z3.simplify(unwrap(symand([symand(wraplist(g))
-                                            for g in subgoals]))))
-    return s
+    if try_harder and fast:
+        raise ValueError("simplify cannot both try harder and be fast")
+    profile = "harder" if try_harder else "fast" if fast else "default"
+
+    key = (z3util.HashableAst(expr), profile)
+    res = _simplify_cache.pop(key, None)
+    if res is None:
+        start = time.time()
+        subgoals = _simplify_tactic(profile)(expr)
+        if len(subgoals[0]) == 0:
+            res = z3.BoolVal(True)
+        else:
+            res = z3.simplify(unwrap(symand([symand(wraplist(g))
+                                             for g in subgoals])))
+        tracer = _query_tracer()
+        if tracer is not None:
+            tracer.record("simplify", start, profile, expr)
+    if options.simplify_cache_size:
+        _simplify_cache[key] = res
+        while len(_simplify_cache) > options.simplify_cache_size:
+            _simplify_cache.popitem(last=False)
+    return wrap(res)
 
 def assume(e):
     """Declare symbolic expression e to be True."""
@@ -1267,42 +2751,58 @@ def assume(e):
         return
 
     scheduler, path_state = Env.scheduler(), Env.path_state()
-
-    # Is this assumption already implied?  This isn't strictly
-    # necessary, but it cleans up generated expressions and the
-    # execution graph.  It also sometimes lets z3 decide a path
-    # condition that it otherwise can't (which is probably a z3 bug).
-    solver = path_state.solver
-    solver.push()
-    solver.add(unwrap(symnot(e)))
-    sat = solver.check()
-    solver.pop()
-    if sat == z3.unsat:
-        return
-
-    # Update the schedule and execution graph.  (We wouldn't need to
-    # track assumptions in the schedule except that we want to avoid
-    # duplicate nodes in the execution graph.)
+    oracle = path_state.oracle
     cursched = path_state.sched
+
     if len(cursched) == path_state.schedidx:
+        # Extend the schedule, either from the plan or by exploring
+        decision = path_state.planned()
+        if decision is None:
+            # Is this assumption already implied?  This isn't strictly
+            # necessary, but it cleans up generated expressions and
+            # the execution graph.  It also sometimes lets z3 decide a
+            # path condition that it otherwise can't (which is
+            # probably a z3 bug).
+            if oracle.check(unwrap(symnot(e)), retry=False,
+                            kind="assume")[0] == z3.unsat:
+                decision = ("implied",)
+        if decision == ("implied",):
+            path_state.decisions.append(decision)
+            return
+
+        # Update the schedule and execution graph.  (We wouldn't need
+        # to track assumptions in the schedule except that we want to
+        # avoid duplicate nodes in the execution graph.)
         cursched.append(SchedNode("assumption", e, True))
-    else:
-        # Check for replay divergence
-        node = cursched[path_state.schedidx]
-        if node.typ != "assumption":
-            raise ReplayDivergedError(node, "assumption")
-        if not node.expr.eq(e):
-            raise ReplayDivergedError(node.expr, e)
-    path_state.schedidx += 1
+        path_state.schedidx += 1
+        oracle.add(unwrap(e))
+        if decision is None:
+            sat, reason = oracle.check(kind="assume")
+            decision = ("assumption", str(sat), reason)
+        path_state.decisions.append(decision)
+
+        if decision[1] == "unsat":
+            raise UnsatisfiablePath()
+        elif decision[1] != "sat":
+            raise UncheckableConstraintError(unwrap(e), decision[2])
+        return
 
-    solver.add(unwrap(e))
-    sat = solver.check()
-    if sat == z3.unknown:
-        s2 = z3.Solver()
-        s2.add(*solver.assertions())
-        sat = s2.check()
-        reason = s2.reason_unknown()
+    # We're replaying.  Skip implied assumptions just like we did
+    # when we extended the schedule.
+    if oracle.check(unwrap(symnot(e)), retry=False,
+                    kind="assume")[0] == z3.unsat:
+        return
 
+    # Check for replay divergence
+    node = cursched[path_state.schedidx]
+    if node.typ != "assumption":
+        raise ReplayDivergedError(node, "assumption")
+    if not node.expr.eq(e):
+        raise ReplayDivergedError(node.expr, e)
+    path_state.schedidx += 1
+
+    oracle.add(unwrap(e))
+    sat, reason = oracle.check(kind="assume")
     if sat == z3.unsat:
         raise UnsatisfiablePath()
     elif sat != z3.sat:
@@ -1369,7 +2869,7 @@ class SymbolicApplyResult(object):
                     res.append(node.path_expr())
             elif node.typ == "branch_nondet":
                 res.append(node.path_expr())
-            elif node.typ == "exception" or node.typ == "note":
+            elif node.typ in ("exception", "note", "merge"):
                 pass
             else:
                 raise ValueError("Unexpected SchedNode type %r" % node)
@@ -1396,14 +2896,18 @@ class SymbolicApplyResult(object):
         strings with identical prefixes represent code paths with
         identical prefixes.
         """
+        # Notes recorded while unwinding from an exception (say, by a
+        # finally clause) may follow the exception node
+        last = next((node for node in reversed(self.__schedule)
+                     if node.typ != "note"), None)
         bitstring = length = 0
         for node in self.__schedule:
             if node.typ == "branch_nondet":
                 bitstring = (bitstring << 1) | node.val
                 length += 1
-            elif node.typ in ("branch_det", "assumption", "note"):
+            elif node.typ in ("branch_det", "assumption", "note", "merge"):
                 continue
-            elif node.typ == "exception" and node is self.__schedule[-1]:
+            elif node.typ == "exception" and node is last:
                 bitstring = (bitstring << 1) | node.expr
                 length += 1
             else:
@@ -1497,45 +3001,474 @@ def symbolic_apply(fn, *args):
     # global environment between code paths.  We want to start each
     # code path from the same environment, so snapshot it now.
     root_env = Env(Env.current())
-    scheduler = Scheduler()
-    graph = SchedGraph()
+    graph = _sched_graph_recorder()
+    if graph is not None:
+        graph.begin_apply(" ".join(getattr(arg, "__name__", str(arg))
+                                   for arg in (fn,) + args))
+
+    try:
+        if options.path_workers > 1:
+            paths = _pool_apply(fn, args, root_env, graph)
+        elif options.fork_checkpoints:
+            paths = _fork_apply(fn, args, root_env, graph)
+        else:
+            paths = _replay_apply(fn, args, root_env, graph)
+        for sar in paths:
+            yield sar
+    finally:
+        if graph is not None:
+            graph.end_apply()
+
+def _replay_apply(fn, args, root_env, graph):
+    """Evaluate fn(*args) by replaying each schedule from the beginning."""
 
+    scheduler = Scheduler(options.search_strategy)
     for cursched in scheduler.schedule_generator():
-        old_env = Env.current()
-        path_state = PathState(cursched)
-        Env(root_env, scheduler, path_state).activate()
-        sar = None
+        env = Env(root_env, scheduler, PathState(cursched))
+        sar = _apply_path(fn, args, env, graph)
+        if sar is not None:
+            yield sar
 
-        #ckx：找到了——的确是有解的路径才被设置为value
-        try:
-            rv = fn(*args)
-            sar = SymbolicApplyResult("value", rv, Env.current())
+def _apply_path(fn, args, env, graph):
+    """Execute one code path of fn(*args) in env.
+
+    Returns the path's SymbolicApplyResult, or None if the path
+    produced no result.  If graph is not None, it must be a
+    SchedGraphRecorder to record the path in.
+    """
+
+    old_env = Env.current()
+    path_state = env.path_state
+    record = graph is not None and graph.next_path()
+    env.activate()
+    sar = None
+
+    #ckx：找到了——的确是有解的路径才被设置为value
+    try:
+        rv = fn(*args)
+        sar = SymbolicApplyResult("value", rv, Env.current())
+        if record:
             graph.add_sched(path_state.sched, str(rv))
-        except UnsatisfiablePath:
+    except InfeasibleBranch:
+        if record:
+            graph.add_sched(path_state.sched, "Infeasible branch", "blue")
+    except UnsatisfiablePath:
+        if record:
             graph.add_sched(path_state.sched, "Unsatisfiable path", "blue")
-            raise
-        except UncheckableConstraintError as e:
-            import traceback
-            traceback.print_exc()
-            print >>sys.stderr, "Ignoring path with uncheckable constraint"
-            sar = SymbolicApplyResult("exception", sys.exc_info(), Env.current())
+        raise
+    except UncheckableConstraintError as e:
+        traceback.print_exc()
+        print >>sys.stderr, "Ignoring path with uncheckable constraint"
+        sar = SymbolicApplyResult("exception", sys.exc_info(), Env.current())
+        if record:
             graph.add_sched(path_state.sched, "Exception: " + str(e), "red")
-        except Exception as e:
+    except Exception as e:
+        if graph is not None:
+            # Always record the failing path
             graph.add_sched(path_state.sched, "Exception: " + str(e), "red")
-            if len(e.args) == 1:
-                e.args = ('%s in symbolic state:\n%s' %
-                          (e.args[0], path_state.str_path()),)
-            else:
-                e.args = e.args + (path_state.str_path(),)
-            graph.show()
-            raise
+        if len(e.args) == 1:
+            e.args = ('%s in symbolic state:\n%s' %
+                      (e.args[0], path_state.str_path()),)
+        else:
+            e.args = e.args + (path_state.str_path(),)
+        raise
+    finally:
+        old_env.activate()
+
+    return sar
+
+def _fork_apply(fn, args, root_env, graph):
+    """Evaluate fn(*args) using forked checkpoints.
+
+    This forks a tree of checkpoint processes to explore the code
+    paths of fn(*args) (see ForkScheduler) and, as each path
+    completes, re-executes it locally by following its recorded
+    decisions.  This yields the same SymbolicApplyResults in the same
+    order as replay mode.
+    """
+
+    sys.stdout.flush()
+    sys.stderr.flush()
+    rfd, wfd = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        status = 1
+        try:
+            os.close(rfd)
+            os.setpgid(0, 0)
+            _fork_worker(wfd, fn, args, root_env)
+            status = 0
         finally:
-            old_env.activate()
+            os._exit(status)
+    os.close(wfd)
+    try:
+        os.setpgid(pid, pid)
+    except OSError:
+        # The child beat us to it
+        pass
 
-        if sar is not None:
-            yield sar
+    records = os.fdopen(rfd, "rb")
+    try:
+        while True:
+            try:
+                typ, plan, detail, work = cPickle.load(records)
+            except EOFError:
+                break
+            _count_work(work)
+            if typ == "drop":
+                continue
+            sar = _follow_record(fn, args, root_env, graph,
+                                 typ, plan, detail, "Checkpoint")
+            if sar is not None:
+                yield sar
+        _, status = os.waitpid(pid, 0)
+        pid = None
+        if status:
+            raise RuntimeError("Checkpoint exited with status %d" % status)
+    finally:
+        records.close()
+        if pid is not None:
+            # We're stopping early; kill the checkpoint tree
+            try:
+                os.killpg(pid, signal.SIGKILL)
+            except OSError:
+                pass
+            os.waitpid(pid, 0)
+
+def _follow_record(fn, args, root_env, graph, typ, plan, detail, what):
+    """Re-execute a path reported by a checkpoint or worker process.
+
+    typ, plan, and detail come from a ("path" or "error", decisions,
+    detail) record.  This follows the decisions in plan without
+    consulting the solver and returns the path's SymbolicApplyResult,
+    or None if the path produced no result.  For an error record, this
+    raises a RuntimeError describing the failure; what names the kind
+    of process that failed.
+    """
 
-#    graph.show()
+    env = Env(root_env, Scheduler(), PathState([], plan, False))
+    if typ == "error":
+        # Reproduce the failure locally if we can, so it carries the
+        # usual symbolic state information.
+        try:
+            _apply_path(fn, args, env, graph)
+        except ReplayDivergedError:
+            pass
+        raise RuntimeError("%s failed:\n%s" % (what, detail))
+    sar = _apply_path(fn, args, env, graph)
+    if len(env.path_state.decisions) != len(plan):
+        raise ReplayDivergedError(plan, env.path_state.decisions)
+    return sar
+
+def _fork_worker(wfd, fn, args, root_env):
+    """Explore fn(*args) as the root of a checkpoint tree.
+
+    Every process in the tree returns from here after completing
+    exactly one path, which it reports on wfd, or after finding that
+    the alternative it follows is infeasible, which it reports as a
+    "drop" record.
+    """
+
+    scheduler = ForkScheduler(wfd)
+    path_state = PathState([])
+    Env(root_env, scheduler, path_state).activate()
+    try:
+        fn(*args)
+        record = ("path", path_state.decisions, None)
+    except (UnsatisfiablePath, UncheckableConstraintError):
+        # The parent will reproduce these when it follows this path
+        record = ("path", path_state.decisions, None)
+    except InfeasibleBranch:
+        record = ("drop", path_state.decisions, None)
+    except Exception:
+        record = ("error", path_state.decisions, traceback.format_exc())
+    scheduler.send(record)
+
+def _pool_apply(fn, args, root_env, graph):
+    """Evaluate fn(*args) using a pool of worker processes.
+
+    Each worker repeatedly takes a schedule, given as a list of
+    decisions, from a shared task queue, follows it, and keeps
+    exploring until its path completes.  Alternatives found along the
+    way come back to this process (see PoolScheduler), which queues
+    them as new tasks.  Finished paths are re-executed locally by
+    following their decisions.  A finished path is only yielded once
+    no outstanding task can produce a path that comes before it in
+    _decision_order, so this yields the same SymbolicApplyResults in
+    the same order as replay mode.
+    """
+
+    sys.stdout.flush()
+    sys.stderr.flush()
+    tasks, results = multiprocessing.Queue(), multiprocessing.Queue()
+    workers = []
+    for i in range(options.path_workers):
+        worker = multiprocessing.Process(
+            target=_pool_worker, args=(tasks, results, fn, args, root_env))
+        worker.daemon = True
+        worker.start()
+        workers.append(worker)
+
+    # Map from task ID to the order key of the task's schedule, for
+    # every task that has been queued but has not finished
+    pending = {}
+    # Heap of finished paths that are waiting for earlier paths
+    done = []
+    taskids = itertools.count()
+    def queue(plan):
+        taskid = next(taskids)
+        pending[taskid] = _decision_order(plan)
+        tasks.put((taskid, plan))
+
+    try:
+        queue([])
+        while True:
+            # Yield every finished path that no outstanding task can
+            # precede
+            while done and (not pending or
+                            done[0][0] < min(pending.itervalues())):
+                _, typ, plan, detail = heapq.heappop(done)
+                sar = _follow_record(fn, args, root_env, graph,
+                                     typ, plan, detail, "Path worker")
+                if sar is not None:
+                    yield sar
+            if not pending:
+                break
+
+            try:
+                msg = results.get(timeout=1)
+            except Queue.Empty:
+                for worker in workers:
+                    if not worker.is_alive():
+                        raise RuntimeError("Path worker exited with status %d"
+                                           % worker.exitcode)
+                continue
+            if msg[0] == "queue":
+                queue(msg[1])
+            else:
+                typ, taskid, plan, detail, work = msg
+                _count_work(work)
+                del pending[taskid]
+                if typ != "drop":
+                    heapq.heappush(done,
+                                   (_decision_order(plan), typ, plan, detail))
+    finally:
+        # Don't wait to flush tasks no worker will take
+        tasks.cancel_join_thread()
+        for worker in workers:
+            if worker.is_alive():
+                worker.terminate()
+            worker.join()
+
+def _pool_worker(tasks, results, fn, args, root_env):
+    """Explore the schedules in tasks until the pool is shut down.
+
+    For each (taskid, decisions) task, this reports the alternatives
+    it finds as ("queue", decisions) records and finally the path it
+    completes as a ("path" or "error", taskid, decisions, detail,
+    work) record on results (see _work_since).  A task that follows an infeasible
+    concolic alternative completes with a "drop" record instead.
+    """
+
+    scheduler = PoolScheduler(results)
+    while True:
+        taskid, plan = tasks.get()
+        base = _work_counters()
+        path_state = PathState([], plan)
+        Env(root_env, scheduler, path_state).activate()
+        try:
+            fn(*args)
+            record = ("path", taskid, path_state.decisions, None)
+        except (UnsatisfiablePath, UncheckableConstraintError):
+            # The parent will reproduce these when it follows this path
+            record = ("path", taskid, path_state.decisions, None)
+        except InfeasibleBranch:
+            record = ("drop", taskid, path_state.decisions, None)
+        except Exception:
+            record = ("error", taskid, path_state.decisions,
+                      traceback.format_exc())
+        results.put(record + (_work_since(base),))
+
+def _same_leaf(a, b):
+    if z3.is_ast(a) and z3.is_ast(b):
+        return a.eq(b)
+    return not z3.is_ast(a) and not z3.is_ast(b) and a == b
+
+def _join(conds, vals):
+    """Return a Z3 value equal to vals[i] where conds[i] holds.
+
+    conds must be mutually exclusive.  The last value is used where
+    none of the other conditions hold.
+    """
+    if all(_same_leaf(val, vals[0]) for val in vals[1:]):
+        return vals[0]
+    res = vals[-1]
+    for cond, val in reversed(zip(conds, vals)[:-1]):
+        res = z3.If(cond, val, res)
+    return res
+
+def _merge_key(res, idx):
+    """Return a key that is equal for results merge_call can join.
+
+    Results can be joined if they are constants of the same sort, or
+    dictionaries with the same keys whose values at each key have the
+    same sort.  idx is the index of the path
+    that returned res, which keeps results that can't be joined in
+    groups of their own.
+    """
+    def sort(val):
+        if isinstance(val, bool):
+            return "Bool"
+        if isinstance(val, (int, long)):
+            return "Int"
+        return str(unwrap(val).sort())
+    if res is None:
+        return None
+    if isinstance(res, (SymbolicConst, bool, int, long)):
+        return ("value", sort(res))
+    if isinstance(res, dict) and \
+       all(isinstance(v, (SymbolicConst, bool, int, long))
+           for v in res.itervalues()):
+        return tuple(sorted((k, sort(v)) for k, v in res.iteritems()))
+    return ("path", idx)
+
+class _MergeScheduler(Scheduler):
+    """A Scheduler that queues alternative schedules as decisions.
+
+    Every path merge_call explores starts from an empty schedule and
+    follows the decisions that lead to it, so the decisions of a
+    finished path describe all of it.
+    """
+
+    def branch(self, path_state, nodes):
+        for node in nodes[1:]:
+            self.queue_schedule(path_state.decisions + [node.decision()])
+        path_state.follow(nodes[0])
+
+def merge_call(fn, state, kwargs):
+    """Call fn(state, **kwargs) with its code paths merged.
+
+    This explores every code path of the call under the current path
+    condition and groups the paths that return None, constants of
+    the same sort, or dictionaries with the same keys and constant
+    values.  The paths in a group are joined into one: the final
+    state and each result value become if-then-else expressions over
+    the paths' conditions.  The current path then branches only
+    between the groups.  state must be a struct and is updated in
+    place.
+
+    The explored paths are recorded in the current schedule as a
+    "merge" node, so replaying the current path (or following its
+    decisions in another process) reproduces them without exploring
+    the call again.
+
+    If any path of the call ends in an unsatisfiable assumption or an
+    uncheckable constraint, this calls fn(state, **kwargs) normally
+    instead.
+    """
+
+    outer_env, outer_state = Env.current(), Env.path_state()
+
+    def run(scheduler, path_state):
+        env = Env(outer_env, scheduler, path_state)
+        nstate = state.copy()
+        nkwargs = {k: v.copy() if isinstance(v, Symbolic) else v
+                   for k, v in kwargs.iteritems()}
+        env.activate()
+        try:
+            return nstate, fn(nstate, **nkwargs), env
+        finally:
+            outer_env.activate()
+
+    def explore():
+        outer_conds = [unwrap(node.path_expr())
+                       for node in outer_state.sched[:outer_state.schedidx]
+                       if node.typ in ("branch_nondet", "branch_det",
+                                       "assumption")]
+        plans = []
+        scheduler = _MergeScheduler()
+        for plan in scheduler.schedule_generator():
+            path_state = PathState([], plan)
+            for cond in outer_conds:
+                path_state.oracle.add(cond)
+            path_state.oracle.model = outer_state.oracle.model
+            try:
+                run(scheduler, path_state)
+            except InfeasibleBranch:
+                continue
+            except (UnsatisfiablePath, UncheckableConstraintError):
+                return None
+            plans.append(path_state.decisions)
+        return plans
+
+    if len(outer_state.sched) == outer_state.schedidx:
+        decision = outer_state.planned()
+        if decision is None:
+            decision = ("merge", explore())
+        elif decision[0] != "merge":
+            raise ReplayDivergedError(decision, "merge")
+        outer_state.follow(SchedNode("merge", None, decision[1]))
+    node = outer_state.sched[outer_state.schedidx]
+    if node.typ != "merge":
+        raise ReplayDivergedError(node, "merge")
+    outer_state.schedidx += 1
+    if not node.val:
+        return fn(state, **kwargs)
+
+    # Reproduce each path from its decisions, which needs no solver
+    # (condition, final state, result, env) for each path
+    paths = []
+    for plan in node.val:
+        path_state = PathState([], plan, False)
+        nstate, res, env = run(Scheduler(), path_state)
+        conds = [unwrap(snode.path_expr()) for snode in path_state.sched
+                 if snode.typ in ("branch_nondet", "assumption")]
+        cond = z3.And(conds) if conds else z3.BoolVal(True)
+        paths.append((cond, nstate._z3_value(), res, env))
+
+    # Keep the declarations the paths made
+    for _, _, _, env in paths:
+        for name, con in env.var_constructors.iteritems():
+            if name not in outer_env.var_constructors:
+                outer_env.var_constructors[name] = con
+        for name, typ in env.const_types.iteritems():
+            if name not in outer_env.const_types:
+                outer_env.const_types[name] = typ
+    outer_env.anon_idx = max(env.anon_idx for _, _, _, env in paths)
+
+    groups = collections.OrderedDict()
+    for idx, path in enumerate(paths):
+        groups.setdefault(_merge_key(path[2], idx), []).append(path)
+
+    def apply(group):
+        conds = [path[0] for path in group]
+        state._set_z3_value(compound_map(lambda *leafs: _join(conds, leafs),
+                                         *[path[1] for path in group]))
+        res = group[0][2]
+        if len(group) == 1 or res is None:
+            return res
+
+        def join_vals(vals):
+            joined = _join(conds, map(unwrap, vals))
+            typ = next((type(v) for v in vals if isinstance(v, Symbolic)),
+                       None)
+            if typ is not None and z3.is_ast(joined):
+                return typ._wrap(joined, None)
+            elif z3.is_ast(joined):
+                return wrap(joined)
+            return joined
+
+        if not isinstance(res, dict):
+            return join_vals([path[2] for path in group])
+        return {key: join_vals([path[2][key] for path in group])
+                for key in res}
+
+    groups = groups.values()
+    for group in groups[:-1]:
+        if symor([wrap(path[0]) for path in group]):
+            return apply(group)
+    assume(symor([wrap(path[0]) for path in groups[-1]]))
+    return apply(groups[-1])
 
 class CheckResult(object):
     def __init__(self, z3_result, extra=None):
@@ -1558,15 +3491,83 @@ class CheckResult(object):
             return self.__extra
         raise ValueError("%s result has no unknown reason" % self.result)
 
-def check(e):
-    solver = z3.Solver()
-    solver.add(unwrap(e))
-    c = solver.check()
-    if c == z3.sat:
-        return CheckResult(c, solver.model())
-    elif c == z3.unknown:
-        return CheckResult(c, solver.reason_unknown())
-    return CheckResult(c)
+def check(e, cache=True):
+    """Check the satisfiability of symbolic expression e.
+
+    If cache is True, the result may come from query_cache.  Callers
+    build test cases from the models returned here, and models found
+    for other queries (particularly by a path's incremental solver)
+    make for more complicated tests, so this only reuses the model of
+    an identical query.
+    """
+
+    key = _conjunct_keys(unwrap(e))
+    cached = query_cache.lookup(key, reuse_models=False) if cache else None
+    if cached is not None:
+        return CheckResult(*cached)
+
+    start = time.time()
+    c, extra = _solve_with("fresh", [unwrap(e)])
+    if c == z3.unknown and options.portfolio:
+        c, extra = _solve_portfolio([unwrap(e)])
+    stats.solver_time += time.time() - start
+    tracer = _query_tracer()
+    if tracer is not None:
+        tracer.record("check", start, c, unwrap(e), 1)
+    dumper = _query_dumper()
+    if dumper is not None:
+        dumper.dump("check", start, c, [unwrap(e)])
+    query_cache.insert(key, c, extra)
+    return CheckResult(c, extra)
+
+class ModelEnumerator(object):
+    """An incremental solver for enumerating models of an expression.
+
+    The expression is asserted once, and each blocking constraint
+    added by block is asserted on top of it, so successive checks
+    reuse the solver's work instead of re-solving the growing
+    conjunction from scratch.
+    """
+
+    def __init__(self, e):
+        self.__solver = _new_solver()
+        self.__solver.add(unwrap(e))
+
+    def block(self, e):
+        """Constrain all future models to satisfy symbolic expression e."""
+        self.__solver.add(unwrap(e))
+
+    def push(self):
+        """Save the current constraints."""
+        self.__solver.push()
+
+    def pop(self):
+        """Discard the constraints added since the matching push."""
+        self.__solver.pop()
+
+    def check(self):
+        """Check the satisfiability of the constraints so far.
+
+        Returns a CheckResult.  Results are never cached, since the
+        solver's state is what makes the next check cheap.
+        """
+        start = time.time()
+        c, extra = _solver_result(self.__solver, self.__solver.check())
+        if c == z3.unknown:
+            # As in BranchOracle, try again from scratch
+            if options.portfolio:
+                c, extra = _solve_portfolio(self.__solver.assertions())
+            else:
+                c, extra = _solve_with("fresh", self.__solver.assertions())
+        stats.solver_time += time.time() - start
+        tracer = _query_tracer()
+        if tracer is not None:
+            tracer.record("check", start, c, None,
+                          len(self.__solver.assertions()))
+        dumper = _query_dumper()
+        if dumper is not None:
+            dumper.dump("check", start, c, self.__solver.assertions())
+        return CheckResult(c, extra)
 
 class Model(object):
     """A Model interprets symbolic expressions into concrete values.
@@ -1667,7 +3668,8 @@ def to_concrete(expr, expr_type=None):
         return True
     if z3.is_false(z3val):
         return False
-    if z3val.sort_kind() == z3.Z3_UNINTERPRETED_SORT:
+    if z3val.sort_kind() == z3.Z3_UNINTERPRETED_SORT or \
+       z3val.sort() in _finite_domains:
         if expr_type is None:
             expr_type = type(expr)
         return expr_type._wrap(z3val, None)
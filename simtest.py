@@ -1,10 +1,13 @@
 """Test the SIM-commutativity of sets of methods."""
 
-__all__ = ['TestResult', 'Divergence', 'ExecutionMonitorBase', 'test_callset']
+__all__ = ['TestResult', 'Divergence', 'ExecutionMonitorBase',
+           'BudgetMonitor', 'test_callset']
 
 import simsym
 import z3
 import collections
+import itertools
+import time
 import progress
 import model
 
@@ -17,7 +20,7 @@ def callseq_name(callseq):
     return ''.join(chr(idx + ord('a')) for idx in callseq)
 
 class TestResult(collections.namedtuple(
-        'TestResult', 'diverge results op_states')):
+        'TestResult', 'diverge results op_states outcomes')):
     """The result of a single SIM commutativity test.
 
     diverge will be an empty list if the calls under test SIM-commute.
@@ -32,6 +35,11 @@ class TestResult(collections.namedtuple(
     method, even though each method may be called multiple times.  If
     the calls are SIM-commutative, then all invocations of a given
     method return the same result anyway.
+
+    outcomes is None unless simsym.options.break_call_symmetry is
+    set and some calls are identical.  Then it is a list giving, for
+    each call, the branches it took on the initial state (see
+    simsym.branch_outcomes).
     """
 
     def __str__(self):
@@ -51,6 +59,206 @@ class Divergence(collections.namedtuple('Divergence', 'typ seq1 seq2')):
         return '%s/%s %s' % (callseq_name(self.seq1), callseq_name(self.seq2),
                              self.typ)
 
+def call_symmetries(calls):
+    """Return the groups of identical calls in a callset.
+
+    Returns a list of lists of indexes into calls.  Each list has at
+    least two elements and gives the indexes of the same method.
+    """
+    groups = collections.OrderedDict()
+    for callidx, call in enumerate(calls):
+        groups.setdefault(call, []).append(callidx)
+    return [group for group in groups.values() if len(group) > 1]
+
+def _arg_consts(calls, callidx):
+    """Return the Z3 constants of call callidx's argument struct.
+
+    The constants are in field name order and are named as test names
+    them.
+    """
+    name = '%s.%s' % (callseq_name([callidx]), calls[callidx].__name__)
+    out = []
+    def rec(path, sort):
+        if isinstance(sort, dict):
+            for k in sorted(sort):
+                rec(path + (k,), sort[k])
+        else:
+            out.append(z3.Const('.'.join((name,) + path), sort))
+    rec((), calls[callidx].arg_struct_type._z3_sort())
+    return out
+
+def in_canonical_order(calls, outcomes):
+    """Return True if identical calls took their branches in order.
+
+    outcomes gives the branch outcomes of each call on the initial
+    state.  Swapping the arguments of identical calls gives a mirror
+    image of a path, in which the calls' outcomes are swapped, so
+    exactly the paths on which the outcomes of each group of
+    identical calls are sorted cover every path up to mirror images.
+    """
+    for group in call_symmetries(calls):
+        for i, j in zip(group, group[1:]):
+            if outcomes[i] > outcomes[j]:
+                return False
+    return True
+
+def _dropped_mirrors(calls, outcomes):
+    # Return the maps from call index to call index that take a path
+    # on which calls had the given branch outcomes to the mirror
+    # images test dropped
+    groups = call_symmetries(calls)
+    res = []
+    for perms in itertools.product(*[itertools.permutations(group)
+                                     for group in groups]):
+        mapping = {src: dst for group, perm in zip(groups, perms)
+                   for src, dst in zip(group, perm) if src != dst}
+        image = list(outcomes)
+        for src, dst in mapping.items():
+            image[dst] = outcomes[src]
+        if mapping and not in_canonical_order(calls, image):
+            res.append(mapping)
+    return res
+
+def mirror_images(calls, expr, outcomes):
+    """Return expr and the images of its path dropped as mirrors.
+
+    This is the post-hoc expansion for options.break_call_symmetry.
+    expr is the path condition of a path on which calls had the
+    given branch outcomes on the initial state.  For each way of
+    permuting the arguments among each group of identical calls
+    that gives a path not in canonical order (which test dropped),
+    this substitutes the permuted arguments into Z3 expression expr.
+    """
+    consts = {}
+    res = [expr]
+    for mapping in _dropped_mirrors(calls, outcomes):
+        pairs = []
+        for src, dst in mapping.items():
+            for callidx in (src, dst):
+                if callidx not in consts:
+                    consts[callidx] = _arg_consts(calls, callidx)
+            pairs.extend(zip(consts[src], consts[dst]))
+        res.append(z3.substitute(expr, *pairs))
+    return res
+
+def mirror_divergences(calls, diverge, outcomes):
+    """Return the divergences of the paths dropped as mirrors.
+
+    diverge is the list of Divergences of a path on which calls had
+    the given branch outcomes on the initial state.
+    """
+    res = []
+    for mapping in _dropped_mirrors(calls, outcomes):
+        for d in diverge:
+            seqs = [tuple(mapping.get(callidx, callidx) for callidx in seq)
+                    for seq in (d.seq1, d.seq2)]
+            res.append(Divergence(d.typ, *sorted(seqs)))
+    return res
+
+def _unpruned_conds(base, calls):
+    # Enumerate the paths of calls without breaking call symmetry.
+    # Returns the condition lists, divergences, and internal variables
+    # as test_callset collects them.
+    condlists = collections.defaultdict(list)
+    diverged, internals = set(), []
+    saved = simsym.options.break_call_symmetry
+    simsym.options.break_call_symmetry = False
+    try:
+        for sar in simsym.symbolic_apply(test, base, *calls):
+            if sar.type == 'value':
+                condlists[len(sar.value.diverge) == 0].append(
+                    sar.path_condition)
+                diverged.update(sar.value.diverge)
+                internals.extend(sar.internals)
+    finally:
+        simsym.options.break_call_symmetry = saved
+    return condlists, diverged, internals
+
+def same_conds(condlists1, condlists2):
+    """Return whether two sets of commutativity conditions agree.
+
+    condlists1 and condlists2 map True and False to the lists of path
+    conditions of commutative and non-commutative paths.  Returns a
+    simsym.CheckResult for a query that is unsat if the disjunctions
+    of the lists are equivalent.
+    """
+    differ = []
+    for key in (True, False):
+        ors = [z3.Or([z3.BoolVal(False)] +
+                     [simsym.unwrap(c) for c in condlists.get(key, [])])
+               for condlists in (condlists1, condlists2)]
+        differ.append(z3.Xor(*ors))
+    return simsym.check(simsym.wrap(z3.Or(differ)))
+
+def _footprint_run(base, call, callidx):
+    # Invoke call as call callidx of a test, so its arguments have
+    # the same names they have in test.
+    arg_name = '%s.%s' % (callseq_name([callidx]), call.__name__)
+    arg_struct = call.arg_struct_type.var(arg_name)
+    init = base.var(base.__name__)
+    state = init.copy()
+    reads = set()
+    env = simsym.Env.current()
+    anon_idx = env.anon_idx
+    model.cur_thread_idx = callidx
+    simsym.track_field_reads(state, reads)
+    try:
+        call(state, **{arg: getattr(arg_struct, arg)
+                       for arg in arg_struct._fields})
+    finally:
+        simsym.track_field_reads(None)
+        model.cur_thread_idx = None
+    if env.anon_idx != anon_idx:
+        # Fresh variables get different names in each call order, so
+        # the call may not commute with itself, let alone others
+        return None
+    return reads, state._written_fields(init)
+
+# Mapping from (base, call, callidx) to footprint
+_footprints = {}
+
+def footprint(base, calls, callidx):
+    """Return the (reads, writes) footprint of calls[callidx].
+
+    reads and writes are frozensets of the names of the top-level
+    fields of base that the call may read or write on any code path.
+    Reads are field fetches by attribute access; writes are fields
+    whose value differs from the initial state.  Returns None if the
+    footprint is unknown because some code path failed or created
+    fresh variables.
+    """
+    call = calls[callidx]
+    key = (base, call, callidx)
+    if key in _footprints:
+        return _footprints[key]
+    res = reads, writes = set(), set()
+    for sar in simsym.symbolic_apply(_footprint_run, base, call, callidx):
+        if sar.type != 'value' or sar.value is None:
+            res = None
+            break
+        reads.update(sar.value[0])
+        writes.update(sar.value[1])
+    if res is not None:
+        res = (frozenset(reads), frozenset(writes))
+    _footprints[key] = res
+    return res
+
+def disjoint_footprints(base, calls):
+    """Return True if calls always commute because of their footprints.
+
+    This holds if no call writes a field that another call reads or
+    writes, in which case the calls SIM-commute on every code path
+    and test would find no divergence.  This is conservative: it
+    returns False if any footprint is unknown.
+    """
+    fps = [footprint(base, calls, callidx) for callidx in range(len(calls))]
+    if None in fps:
+        return False
+    for (ra, wa), (rb, wb) in itertools.combinations(fps, 2):
+        if wa & (rb | wb) or wb & ra:
+            return False
+    return True
+
 def test(base, *calls):
     """Test for SIM commutativity of calls
 
@@ -83,6 +291,18 @@ def test(base, *calls):
     # List of Divergences
     diverge = []
 
+    # The branch outcomes of each call on the initial state, if
+    # breaking call symmetry.  This is only sound if swapping the
+    # arguments of identical calls maps each path to another path,
+    # which the model class promises by setting symmetric_calls: its
+    # methods must not depend on which call of the test they are
+    # (say, through model.cur_thread or argument names) or create
+    # fresh variables, whose names include the call sequence.
+    outcomes = None
+    if simsym.options.break_call_symmetry and \
+       getattr(base, 'symmetric_calls', False) and call_symmetries(calls):
+        outcomes = [None] * len(calls)
+
     # Explore every permutation of calls, requiring that the state
     # following every permutation of every subset of callseq be the
     # same.  This uses a depth-first walk of every n-step path from
@@ -91,8 +311,9 @@ def test(base, *calls):
     # (the edge's direction determines which call) and each vertex a
     # state.  Where these paths rejoin, the states must be equal.
     # This way, we make the minimal number of calls and state
-    # comparisons possible.
-    def rec(callseq):
+    # comparisons possible.  If recurse is False, this only extends
+    # callseq by one call.
+    def rec(callseq, recurse=True):
         base_state = perm_states[frozenset(callseq)][1]
 
         # Extend callseq in every way that doesn't duplicate a call
@@ -108,6 +329,7 @@ def test(base, *calls):
             simsym.anon_info = '_seq' + seqname
             # Record our call sequence as a schedule note
             simsym.note(('begin', ncallseq))
+            start = simsym.sched_index()
 
             # Build the Python arguments dictionary and copy each
             # argument, just in case the call mutates it
@@ -119,9 +341,14 @@ def test(base, *calls):
             model.cur_thread_idx = callidx
             res = None
             try:
-                res = calls[callidx](nstate, **cargs)
+                if simsym.options.merge_calls:
+                    res = simsym.merge_call(calls[callidx], nstate, cargs)
+                else:
+                    res = calls[callidx](nstate, **cargs)
             finally:
                 model.cur_thread_idx = None
+                if outcomes is not None and not callseq:
+                    outcomes[callidx] = simsym.branch_outcomes(start)
                 simsym.note(('end', ncallseq, res))
 
             # Record or check result
@@ -134,8 +361,12 @@ def test(base, *calls):
                 # We've called this call before.  Check that its
                 # result agrees.
                 if call_result[1] != res:
+                    # Name the sequences in the order rec(()) would
+                    # first run them, even if we ran every call on
+                    # the initial state first
                     diverge.append(
-                        Divergence('result', call_result[0], ncallseq))
+                        Divergence('result',
+                                   *sorted([call_result[0], ncallseq])))
             if diverge:
                 return
 
@@ -146,22 +377,34 @@ def test(base, *calls):
                 # This is the first permutation of these calls we've
                 # executed.  Record the state and recurse.
                 perm_states[frozenset(ncallseq)] = (ncallseq, nstate)
-                rec(ncallseq)
+                if recurse:
+                    rec(ncallseq)
             else:
                 # We've executed some other permutation of these calls
                 # already.  Check that the state agrees.  Recursing
                 # from here would be redundant.
                 if perm_state[1] != nstate:
-                    diverge.append(Divergence('state', perm_state[0], ncallseq))
+                    diverge.append(Divergence(
+                        'state', *sorted([perm_state[0], ncallseq])))
     try:
-        rec(())
+        if outcomes is None:
+            rec(())
+        else:
+            # Run every call on the initial state first, so we can
+            # drop mirror image paths before exploring further.
+            # test_callset expands the results.
+            rec((), False)
+            if not in_canonical_order(calls, outcomes):
+                raise simsym.PrunedPath()
+            for callidx in range(len(calls)):
+                rec((callidx,))
     finally:
         simsym.anon_info = ''
 
     return TestResult(diverge,
                       [call_results[callidx][1]
                        for callidx in range(len(calls))],
-                      op_states)
+                      op_states, outcomes)
 
 class ExecutionMonitorBase(object):
     """Base class for model execution monitoring."""
@@ -196,7 +439,12 @@ class ExecutionMonitorBase(object):
         self.__callset = callset
 
     def stop_call_set(self):
-        """Return True if path enumeration should stop for this call set."""
+        """Return True if path enumeration should stop for this call set.
+
+        Instead of True, this may return a string giving the reason
+        enumeration should stop, which will be passed to
+        incomplete_call_set.
+        """
         return False
 
     def on_path(self, result):
@@ -208,6 +456,15 @@ class ExecutionMonitorBase(object):
         """
         pass
 
+    def incomplete_call_set(self, reason):
+        """Handle the early termination of a call set.
+
+        This is called before end_call_set if path enumeration stopped
+        before covering all of the call set's code paths.  reason is a
+        string describing why enumeration stopped.
+        """
+        pass
+
     def end_call_set(self):
         """Handle the end of a call set."""
         self.__callset = None
@@ -226,9 +483,27 @@ class StatMonitor(ExecutionMonitorBase):
     def __init__(self):
         super(StatMonitor, self).__init__()
         self.npath = self.ncompath = 0
+        self.__cache_base = (0, 0)
 
     def get_progress_format(self):
-        return '{0.npath} paths ({0.ncompath} commutative)'
+        fmt = '{0.npath} paths ({0.ncompath} commutative)'
+        if simsym.options.query_cache_size:
+            fmt += ', {0.ncachehit}/{0.ncachequery} cached queries'
+        return fmt
+
+    @property
+    def ncachehit(self):
+        return simsym.query_cache.hits - self.__cache_base[0]
+
+    @property
+    def ncachequery(self):
+        return (simsym.query_cache.hits + simsym.query_cache.misses -
+                sum(self.__cache_base))
+
+    def begin_call_set(self, callset):
+        super(StatMonitor, self).begin_call_set(callset)
+        self.__cache_base = (simsym.query_cache.hits,
+                             simsym.query_cache.misses)
 
     def on_path(self, result):
         super(StatMonitor, self).on_path(result)
@@ -237,6 +512,41 @@ class StatMonitor(ExecutionMonitorBase):
         if result.type == 'value' and len(result.value.diverge) == 0:
             self.ncompath += 1
 
+class BudgetMonitor(ExecutionMonitorBase):
+    """Stop path enumeration when a call set exhausts its budget.
+
+    max_paths limits the number of code paths, max_time the wall-clock
+    seconds, and max_solver_time the seconds spent in solver checks
+    for each call set.  Any of these may be None for no limit.
+    """
+
+    def __init__(self, max_paths=None, max_time=None, max_solver_time=None):
+        super(BudgetMonitor, self).__init__()
+        self.max_paths, self.max_time, self.max_solver_time \
+            = max_paths, max_time, max_solver_time
+
+    def begin_call_set(self, callset):
+        super(BudgetMonitor, self).begin_call_set(callset)
+        self.__npath = 0
+        self.__start = time.time()
+        self.__solver_start = simsym.stats.solver_time
+
+    def stop_call_set(self):
+        if self.max_paths is not None and self.__npath >= self.max_paths:
+            return 'path budget exhausted'
+        if self.max_time is not None and \
+           time.time() - self.__start >= self.max_time:
+            return 'time budget exhausted'
+        if self.max_solver_time is not None and \
+           simsym.stats.solver_time - self.__solver_start \
+           >= self.max_solver_time:
+            return 'solver time budget exhausted'
+        return False
+
+    def on_path(self, result):
+        super(BudgetMonitor, self).on_path(result)
+        self.__npath += 1
+
 class MetaMonitor(ExecutionMonitorBase):
     def __init__(self, monitors):
         self._monitors = monitors
@@ -251,12 +561,20 @@ class MetaMonitor(ExecutionMonitorBase):
             m.begin_call_set(callset)
 
     def stop_call_set(self):
-        return any(m.stop_call_set() for m in self._monitors)
+        for m in self._monitors:
+            stop = m.stop_call_set()
+            if stop:
+                return stop
+        return False
 
     def on_path(self, result):
         for m in self._monitors:
             m.on_path(result)
 
+    def incomplete_call_set(self, reason):
+        for m in self._monitors:
+            m.incomplete_call_set(reason)
+
     def end_call_set(self):
         for m in self._monitors:
             m.end_call_set()
@@ -322,6 +640,7 @@ def test_callset(base, callset, monitors,
     monitor = MetaMonitor([StatMonitor()] + monitors)
 
     print ' '.join([c.__name__ for c in callset])
+    simsym.query_trace_info['callset'] = '_'.join(c.__name__ for c in callset)
     monitor.begin_call_set(callset)
     
     reporter = progress.ProgressReporter(
@@ -329,6 +648,8 @@ def test_callset(base, callset, monitors,
 
     condlists = collections.defaultdict(list)
     terminated = False
+    truncated = None
+    pruned = False
     diverged = set()
     all_internals = []
     #ckx：猜测是有些路径没有得出解，就不计入commutative path
@@ -337,21 +658,53 @@ def test_callset(base, callset, monitors,
         if sar.type == 'value':
             is_commutative = (len(sar.value.diverge) == 0)
             diverged.update(sar.value.diverge)
-            condlists[is_commutative].append(sar.path_condition)
+            pc = sar.path_condition
+            if sar.value.outcomes is not None:
+                pruned = True
+                diverged.update(mirror_divergences(
+                    callset, sar.value.diverge, sar.value.outcomes))
+                condlists[is_commutative].extend(
+                    map(simsym.wrap,
+                        mirror_images(callset, simsym.unwrap(pc),
+                                      sar.value.outcomes)))
+            else:
+                condlists[is_commutative].append(pc)
             all_internals.extend(sar.internals)
+        elif isinstance(sar.exc_info[1], simsym.PathDepthExceeded):
+            # The rest of this subtree was cut off
+            truncated = str(sar.exc_info[1])
         #ckx: commutative path 计数的地方
         monitor.on_path(sar)
-        if monitor.stop_call_set():
-            terminated = True
+        terminated = monitor.stop_call_set()
+        if terminated:
             break
 
+    if not terminated and truncated:
+        terminated = truncated
+    if terminated:
+        reason = terminated
+        if not isinstance(reason, basestring):
+            reason = 'stopped'
+        monitor.incomplete_call_set(reason)
     monitor.end_call_set()
     reporter.end()
+    del simsym.query_trace_info['callset']
 
     if terminated:
-        print '  enumeration incomplete; skipping conditions'
+        print '  enumeration incomplete (%s); skipping conditions' % reason
         return
 
+    if pruned and check_conds:
+        # Check that breaking call symmetry lost no paths
+        full = _unpruned_conds(base, callset)
+        res = same_conds(condlists, full[0])
+        if res.is_unsat:
+            print '  call symmetry: conditions verified'
+        else:
+            print '  call symmetry: conditions %s; using all paths' % \
+                ('differ' if res.is_sat else 'unverified')
+            condlists, diverged, all_internals = full
+
     conds = collections.defaultdict(lambda: [simsym.wrap(z3.BoolVal(False))])
     for result, condlist in condlists.items():
         conds[result] = condlist
@@ -10,11 +10,16 @@ import sys
 import argparse
 import os
 import z3util
+import z3ast
 import pprint
 import json
+import hashlib
+import re
+import inspect
 import testgen
 import traceback
 import importlib
+from tools import modelfile
 
 # A test module must have the following two attributes:
 #
@@ -38,17 +43,24 @@ def expr_vars(e):
     """
 
     res = z3util.AstSet()
-    def rec(e):
-        if not z3.is_ast(e):
-            return
-        if z3.is_const(e) and e.decl().kind() == z3.Z3_OP_UNINTERPRETED:
-            res.add(e)
-            return
-        for child in e.children():
-            rec(child)
-    rec(simsym.unwrap(e))
+    e = simsym.unwrap(e)
+    if z3.is_ast(e):
+        for var in z3ast.free_var_asts(e):
+            res.add(var)
     return res
 
+def shares_vars(a, b):
+    """Return True if a and b have an uninterpreted constant in common.
+
+    This is equivalent to testing the expr_vars of a and b for
+    disjointness, but reuses the cached variable sets of a and b and
+    their subterms.
+    """
+    a, b = simsym.unwrap(a), simsym.unwrap(b)
+    if not z3.is_ast(a) or not z3.is_ast(b):
+        return False
+    return not z3ast.isdisjoint(a, b)
+
 class IsomorphicMatch(object):
     """Construct an expression that matches isomorphisms of a set of conditions.
 
@@ -128,6 +140,103 @@ class IsomorphicMatch(object):
 
         return simsym.symand(conds)
 
+    def terms(self):
+        """Return the terms constrained by the isomorphism condition.
+
+        This returns two lists.  The first has one element for each
+        realm, giving the list of that realm's equivalence classes,
+        each as a list of expressions.  The second gives the value
+        conditions of the default realm.
+        """
+        classes = [[list(reps) for reps in rep_map.itervalues()]
+                   for rep_map in self.__repmaps.itervalues()]
+        conds = [cond for cond in self.__conds
+                 if isinstance(cond, simsym.Symbolic)]
+        return classes, conds
+
+class PatternEnumerator(object):
+    """Enumerate the models of a path condition by equality pattern.
+
+    Rather than blocking each test's isomorphism condition, this
+    takes the terms constrained by the first test's condition and
+    walks the equality patterns over them directly: each realm's
+    terms are partitioned in restricted-growth order (a term joins a
+    block opened by an earlier term or opens the next block) and each
+    default realm condition is taken to be true or false.  A prefix
+    of a pattern is checked before it is extended, so inconsistent
+    prefixes prune all their patterns, and every query carries only
+    the constraints of one pattern.
+    """
+
+    def __init__(self, e):
+        self.__e = e
+        self.__patterns = None
+        # The path condition and pattern of the last model
+        self.constraint = e
+
+    def check(self):
+        """Return a CheckResult for the next pattern."""
+        if self.__patterns is None:
+            return simsym.check(self.__e)
+        return next(self.__patterns, simsym.CheckResult(z3.unsat))
+
+    def add_test(self, same):
+        """Record the IsomorphicMatch of a generated test.
+
+        Only the first test's match is used; it determines the terms
+        to enumerate patterns over.
+        """
+        if self.__patterns is None:
+            self.__patterns = self.__enumerate(*same.terms())
+
+    def __enumerate(self, classes, conds):
+        # Each step places one term.  first is the pattern of the
+        # first test, which has already been generated.
+        steps, first = [], []
+        for realm, groups in enumerate(classes):
+            for block, group in enumerate(groups):
+                for expr in group:
+                    steps.append((realm, expr))
+                    first.append(block)
+        for cond in conds:
+            steps.append((None, cond))
+            first.append(0)
+        first = tuple(first)
+
+        solver = simsym.ModelEnumerator(self.__e)
+        reps = collections.defaultdict(list)
+        def rec(choices, pattern, check):
+            if len(choices) == len(steps):
+                if choices != first:
+                    self.constraint = simsym.symand([self.__e] + pattern)
+                    yield check
+                return
+            realm, term = steps[len(choices)]
+            if realm is None:
+                alts = [term, simsym.symnot(term)]
+            else:
+                rrep = reps[realm]
+                alts = [term == rep for rep in rrep]
+                alts.append(simsym.distinct(term, *rrep) if rrep else True)
+            for choice, cond in enumerate(alts):
+                solver.push()
+                solver.block(cond)
+                check = solver.check()
+                if check.is_unknown:
+                    yield check
+                    return
+                if check.is_sat:
+                    opened = realm is not None and choice == len(rrep)
+                    if opened:
+                        rrep.append(term)
+                    for res in rec(choices + (choice,), pattern + [cond],
+                                   check):
+                        yield res
+                    if opened:
+                        rrep.pop()
+                solver.pop()
+        return rec((), [], None)
+
 def idempotent_projs(result, iso_constraint=True):
     """Returns the projections for which each call in result is idempotent.
 
@@ -224,11 +333,151 @@ def idempotent_projs(result, iso_constraint=True):
         res.append(idem_projs)
     return res, unknown_count[0]
 
+# Arguments that don't affect the paths or tests of a run
+UNFINGERPRINTED_ARGS = {
+    'check_conds', 'print_conds', 'model_file', 'trace_file', 'test_file',
+    'sched_graph', 'sched_graph_sample', 'query_trace', 'query_dump',
+    'verbose_testgen', 'diff_testgen', 'journal', 'resume', 'result_cache'}
+
+def run_fingerprint(args, module):
+    """Return a hash of the model source and options of a run.
+
+    A journal can only be resumed by a run with the same fingerprint.
+    """
+    h = hashlib.sha1()
+    mods = [module]
+    if hasattr(module, 'model_testgen'):
+        mods.append(sys.modules[module.model_testgen.__module__])
+    for mod in mods:
+        h.update(file(inspect.getsourcefile(mod)).read())
+    opts = {k: v for k, v in vars(args).iteritems()
+            if k not in UNFINGERPRINTED_ARGS}
+    h.update(json.dumps(opts, sort_keys=True))
+    return h.hexdigest()
+
+# Modules whose source affects the results of every call set
+ENGINE_MODULES = ['simsym', 'simtest', 'spec', 'symtypes', 'model',
+                  'testgen', 'z3util', 'z3ast']
+
+def _model_source(base, callset):
+    """Return the source of base's module, less unused model methods.
+
+    The model methods that are not in callset and that no remaining
+    code refers to as an attribute are cut out, so editing them does
+    not change the result.  Everything else, including helpers and
+    type definitions, is kept.
+    """
+    path = inspect.getsourcefile(sys.modules[base.__module__])
+    lines = file(path).readlines()
+    spans = {}
+    for name in dir(base):
+        meth = getattr(base, name)
+        if name in callset or not getattr(meth, 'is_model_function', False) \
+           or inspect.getsourcefile(meth) != path:
+            continue
+        # For decorated methods, this includes the decorators
+        mlines, start = inspect.getsourcelines(meth)
+        spans[name] = (start - 1, start - 1 + len(mlines))
+    while True:
+        cut = set()
+        for start, end in spans.itervalues():
+            cut.update(xrange(start, end))
+        kept = ''.join(line for i, line in enumerate(lines) if i not in cut)
+        used = [name for name in spans
+                if re.search(r'\.%s\b' % re.escape(name), kept)]
+        if not used:
+            return kept
+        for name in used:
+            del spans[name]
+
+def callset_key(args, module, callset):
+    """Return a hash of everything that determines callset's results.
+
+    This covers the source of the engine, of the call set's methods
+    and the rest of the model except other model methods (see
+    _model_source), of the test generator, and the options of the
+    run.  Call sets with the same key produce the same outputs.
+    """
+    h = hashlib.sha1()
+    h.update(z3.get_version_string())
+    for name in ENGINE_MODULES:
+        mod = importlib.import_module(name)
+        h.update(file(inspect.getsourcefile(mod)).read())
+    h.update(_model_source(module.model_class, callset))
+    if hasattr(module, 'model_testgen'):
+        testgen_mod = sys.modules[module.model_testgen.__module__]
+        h.update(file(inspect.getsourcefile(testgen_mod)).read())
+    opts = {k: v for k, v in vars(args).iteritems()
+            if k not in UNFINGERPRINTED_ARGS and k != 'functions'}
+    opts['callset'] = sorted(callset)
+    h.update(json.dumps(opts, sort_keys=True))
+    return h.hexdigest()
+
+def read_journal(path, fingerprint):
+    """Read the run journal at path.
+
+    Returns the set of names of finished call sets and a dictionary
+    mapping (callset name, pathid) of each finished path to its
+    number of tests.  Raises ValueError if the journal was written by
+    a run with a different fingerprint.
+    """
+    callsets, paths = set(), {}
+    with open(path) as fp:
+        header = json.loads(fp.readline() or '{}')
+        if header.get('fingerprint') != fingerprint:
+            raise ValueError('Journal %s is for a different model or options'
+                             % path)
+        for line in fp:
+            if not line.endswith('\n'):
+                break
+            rec = json.loads(line)
+            if rec['type'] == 'callset':
+                callsets.add(rec['callset'])
+            elif rec['type'] == 'path':
+                paths[rec['callset'], rec['pathid']] = rec['ntests']
+    return callsets, paths
+
+class RunJournal(object):
+    """A record of the work a run has finished.
+
+    The journal is a file of JSON lines: a header with the run's
+    fingerprint, then a record for each path as TestWriter finishes
+    it and for each call set whose paths were all enumerated.  If
+    resume is true and the journal exists, this loads it and appends
+    to it; the run should then skip the work it records.
+    """
+
+    def __init__(self, path, fingerprint, resume):
+        self.resumed = resume and os.path.exists(path)
+        if self.resumed:
+            self.done_callsets, self.done_paths \
+                = read_journal(path, fingerprint)
+            self.__fp = modelfile.open_append(path)
+        else:
+            self.done_callsets, self.done_paths = set(), {}
+            self.__fp = open(path, 'w')
+            self.__write({'type': 'header', 'fingerprint': fingerprint})
+
+    def __write(self, rec):
+        self.__fp.write(json.dumps(rec) + '\n')
+        self.__fp.flush()
+
+    def path_done(self, callset, pathid, ntests):
+        self.__write({'type': 'path', 'callset': callset, 'pathid': pathid,
+                      'ntests': ntests})
+
+    def callset_done(self, callset):
+        self.__write({'type': 'callset', 'callset': callset})
+
 class TestWriter(simtest.ExecutionMonitorBase):
-    def __init__(self, trace_file, model_file, test_file, testgen):
+    def __init__(self, trace_file, model_file, test_file, testgen,
+                 stream_model=False, journal=None):
         super(TestWriter, self).__init__()
+        # Resumed runs add to the outputs of the runs they resume
+        self.journal = journal
+        resumed = journal is not None and journal.resumed
         if isinstance(trace_file, basestring):
-            trace_file = open(trace_file, 'w')
+            trace_file = open(trace_file, 'a' if resumed else 'w')
         self.trace_file, self.model_file, self.test_file \
             = trace_file, model_file, test_file
         if test_file and testgen:
@@ -236,7 +485,7 @@ class TestWriter(simtest.ExecutionMonitorBase):
         else:
             self.testgen = None
 
-        # model_data schema:
+        # Model file schema (see tools/modelfile for the formats):
         #   root     -> {'tests': {callsetname: {pathid: pathinfo}}}
         #   callsetname -> '_'-joined call names
         #   pathinfo -> {'id': pathname,
@@ -253,7 +502,16 @@ class TestWriter(simtest.ExecutionMonitorBase):
         #                'idempotent_projs': [[string]],
         #                'idempotence_unknown': int}  # if non-zero
         #   testname -> pathname '_' testnum
-        self.model_data = {'tests':{}}
+        #   root['incomplete'] -> {callsetname: reason}
+        #     Call sets whose path enumeration stopped early, with
+        #     the reason (e.g., 'time budget exhausted').
+        self.model_writer = None
+        if model_file is not None:
+            if stream_model:
+                self.model_writer = modelfile.StreamWriter(model_file,
+                                                           resumed)
+            else:
+                self.model_writer = modelfile.NestedWriter(model_file)
 
         self.nmodel = self.nerror = self.ntesterrors = 0
 
@@ -267,11 +525,11 @@ class TestWriter(simtest.ExecutionMonitorBase):
                 " ".join(self.callset_names)
             print >> self.trace_file
 
-        self.model_data_callset = collections.OrderedDict()
-        self.model_data['tests']['_'.join(c.__name__ for c in callset)] \
-            = self.model_data_callset
+        if self.model_writer:
+            self.model_writer.begin_call_set('_'.join(self.callset_names))
 
         self.nmodel = self.nerror = self.ntesterrors = 0
+        self.incomplete = False
 
         if self.testgen:
             self.testgen.begin_call_set(callset)
@@ -279,7 +537,16 @@ class TestWriter(simtest.ExecutionMonitorBase):
     def stop_call_set(self):
         if self.testgen and self.testgen.stop_call_set():
             return True
-        return self.nmodel >= args.max_testcases
+        if self.nmodel >= args.max_testcases:
+            return 'max testcases reached'
+        return False
+
+    def incomplete_call_set(self, reason):
+        super(TestWriter, self).incomplete_call_set(reason)
+        self.incomplete = True
+        if self.model_writer:
+            self.model_writer.incomplete_call_set(
+                '_'.join(self.callset_names), reason)
 
     def _testerror(self, reason, pathinfo):
         pathinfo['testerror'] = reason
@@ -290,10 +557,36 @@ class TestWriter(simtest.ExecutionMonitorBase):
     def on_path(self, result):
         super(TestWriter, self).on_path(result)
 
-        pathinfo = collections.OrderedDict([
-            ('id', '_'.join(self.callset_names) + '_' + result.pathid)])
-        self.model_data_callset[result.pathid] = pathinfo
+        callsetname = '_'.join(self.callset_names)
+        if self.journal:
+            ntests = self.journal.done_paths.get((callsetname, result.pathid))
+            if ntests is None and self.journal.resumed and self.model_writer:
+                # The resumed run may have died between writing the
+                # path's model record and journaling it
+                pathinfo = self.model_writer.get_path(callsetname,
+                                                      result.pathid)
+                if pathinfo is not None:
+                    ntests = len(pathinfo.get('tests', []))
+                    self.journal.path_done(callsetname, result.pathid, ntests)
+            if ntests is not None:
+                # The resumed run already wrote this path
+                self.nmodel += ntests
+                return
 
+        pathinfo = collections.OrderedDict([
+            ('id', callsetname + '_' + result.pathid)])
+        try:
+            self.__on_path(result, pathinfo)
+        finally:
+            if self.model_writer:
+                self.model_writer.add_path(
+                    callsetname, result.pathid, pathinfo)
+        # Journal the path only once its model record is written
+        if self.journal:
+            self.journal.path_done(callsetname, result.pathid,
+                                   len(pathinfo.get('tests', [])))
+
+    def __on_path(self, result, pathinfo):
         if result.type == 'exception':
             pathinfo['exception'] = '\n'.join(
                 traceback.format_exception_only(*result.exc_info[:2]))
@@ -329,19 +622,21 @@ class TestWriter(simtest.ExecutionMonitorBase):
             print >> self.trace_file, e
             print >> self.trace_file
 
-        # Find the uninterpreted constants in the path condition.  We
-        # omit assumptions because uninterpreted constants that appear
-        # only in assumptions generally don't represent that the model
+        # Find the expression whose uninterpreted constants the tests
+        # care about (see shares_vars below).  We omit assumptions
+        # because uninterpreted constants that appear only in
+        # assumptions generally don't represent that the model
         # actually "touched".  We use the simplified expression
         # because the final state comparison in original expression
         # contains a lot of trivial expressions like x==x for all
         # state variables x, and we don't care about these
-        # uninterpreted constants.
-        e_vars = expr_vars(
-            simsym.simplify(
-                simsym.symand(
-                    result.get_path_condition_list(
-                        with_assume=False, with_det=True))))
+        # uninterpreted constants.  Rewriting is enough to eliminate
+        # those, so use the fast simplifier.
+        e_touched = simsym.simplify(
+            simsym.symand(
+                result.get_path_condition_list(
+                    with_assume=False, with_det=True)),
+            fast=True)
 
         if self.testgen:
             self.testgen.begin_path(result)
@@ -349,19 +644,30 @@ class TestWriter(simtest.ExecutionMonitorBase):
         self.model_data_testinfo_list = []
         pathinfo['tests'] = self.model_data_testinfo_list
 
+        simsym.query_trace_info['pathid'] = result.pathid
         self.npathmodel = 0
         self.last_assignments = None
+        enum = canon = None
+        if args.canonical_testgen:
+            canon = PatternEnumerator(e)
+        elif args.incremental_testgen:
+            enum = simsym.ModelEnumerator(e)
         while not self.stop_call_set() and \
               self.npathmodel < args.max_tests_per_path:
-            # XXX Would it be faster to reuse the solver?
-            check = simsym.check(e)
+            if canon is not None:
+                check = canon.check()
+                e = canon.constraint
+            elif enum is not None:
+                check = enum.check()
+            else:
+                check = simsym.check(e)
             if check.is_sat and 'array-ext' in check.z3_model.sexpr():
                 # Work around some non-deterministic bug that causes
                 # Z3 to occasionally produce models containing
                 # 'array-ext' applications that break evaluation.
                 print 'Warning: Working around array-ext bug'
                 for i in range(10):
-                    check = simsym.check(e)
+                    check = simsym.check(e, cache=False)
                     if not check.is_sat:
                         continue
                     if 'array-ext' not in check.z3_model.sexpr():
@@ -422,8 +728,7 @@ class TestWriter(simtest.ExecutionMonitorBase):
             same = IsomorphicMatch()
             for realm, rassigns in assignments.iteritems():
                 for aexpr, val in rassigns:
-                    aexpr_vars = expr_vars(aexpr)
-                    if not aexpr_vars.isdisjoint(e_vars):
+                    if shares_vars(aexpr, e_touched):
                         same.add(realm, aexpr, val, result)
                     elif args.verbose_testgen:
                         print 'Ignoring assignment:', (aexpr, val)
@@ -436,12 +741,19 @@ class TestWriter(simtest.ExecutionMonitorBase):
                 if proj_errors:
                     testinfo['idempotence_unknown'] = proj_errors
 
+            if canon is not None:
+                canon.add_test(same)
+                continue
+
             # Construct constraint for next test
             notsame = simsym.symnot(isocond)
             if args.verbose_testgen:
                 print 'Negation', self.nmodel, ':', notsame
             e = simsym.symand([e, notsame])
+            if enum is not None:
+                enum.block(notsame)
 
+        del simsym.query_trace_info['pathid']
         if self.npathmodel == args.max_tests_per_path:
             print '  Max tests reached for path %s' % result.pathid
 
@@ -469,6 +781,8 @@ class TestWriter(simtest.ExecutionMonitorBase):
         return res
 
     def end_call_set(self):
+        if self.journal and not self.incomplete:
+            self.journal.callset_done('_'.join(self.callset_names))
         super(TestWriter, self).end_call_set()
         if self.testgen:
             self.testgen.end_call_set()
@@ -477,8 +791,8 @@ class TestWriter(simtest.ExecutionMonitorBase):
         super(TestWriter, self).finish()
         if self.testgen:
             self.testgen.finish()
-        if self.model_file is not None:
-            json.dump(self.model_data, file(self.model_file, 'w'), indent=2)
+        if self.model_writer:
+            self.model_writer.close()
 
 parser = argparse.ArgumentParser()
 parser.add_argument('-c', '--check-conds', action='store_true',
@@ -491,8 +805,19 @@ parser.add_argument('-pp', '--pretty-print-conds', action='store_const',
                     simplification')
 parser.add_argument('-m', '--model-file',
                     help='Z3 model output file')
+parser.add_argument('--model-format', choices=['nested', 'stream'],
+                    default='nested',
+                    help='Model file format: one JSON object written at the \
+                    end, or a JSON record per path written as it completes \
+                    (see tools/modelfile)')
 parser.add_argument('--trace-file',
                     help='User-readable Z3 model trace output file')
+parser.add_argument('--sched-graph',
+                    help='Execution graph output file (DOT, or JSON lines \
+                    if the name ends in .jsonl)')
+parser.add_argument('--sched-graph-sample', type=int, default=1,
+                    help='Record only every Nth code path in the execution \
+                    graph')
 parser.add_argument('-t', '--test-file',
                     help='Test generator output file')
 parser.add_argument('-n', '--ncomb', type=int, default=2, action='store',
@@ -513,6 +838,83 @@ parser.add_argument('--diff-testgen', default=False, action='store_true',
                     help='Print variables that change during enumeration')
 parser.add_argument('--idempotent-projs', default=False, action='store_true',
                     help='Record idempotent projections in model file (slow)')
+parser.add_argument('--fork-checkpoints', default=False, action='store_true',
+                    help='Explore code paths from forked checkpoints instead \
+                    of replaying each path from the beginning')
+parser.add_argument('--path-workers', type=int,
+                    default=simsym.options.path_workers,
+                    help='Explore the code paths of each call set using this \
+                    many worker processes')
+parser.add_argument('--search-strategy',
+                    choices=simsym.Scheduler.strategies,
+                    default=simsym.options.search_strategy,
+                    help='Order in which to explore code paths')
+parser.add_argument('--search-seed', type=int,
+                    default=simsym.options.search_seed,
+                    help='Random seed for the random search strategy')
+parser.add_argument('--max-path-depth', type=int,
+                    help='Maximum # non-deterministic branches per path')
+parser.add_argument('--path-budget', type=int,
+                    help='Maximum # paths to explore per call set')
+parser.add_argument('--time-budget', type=float,
+                    help='Maximum wall-clock seconds to spend per call set')
+parser.add_argument('--solver-time-budget', type=float,
+                    help='Maximum solver seconds to spend per call set')
+parser.add_argument('--query-cache-size', type=int,
+                    default=simsym.options.query_cache_size,
+                    help='Maximum # solver query results to cache across \
+                    paths and call sets (0 to disable)')
+parser.add_argument('--solver-timeout', type=float,
+                    help='Seconds before a solver check gives up as unknown')
+parser.add_argument('--portfolio', default='',
+                    help='Comma-separated solver strategies to race when a \
+                    check is unknown (fresh, seed:N, tactic:NAME); a \
+                    tactic only decides queries in its fragment, such \
+                    as quantifier-free ones')
+parser.add_argument('--query-trace',
+                    help='Solver query trace output file (JSON lines; see \
+                    tools/query-report)')
+parser.add_argument('--query-dump', metavar='DIR',
+                    help='Write every solver query to DIR as an SMT-LIB2 \
+                    file (see tools/query-bench)')
+parser.add_argument('--concolic', action='store_true',
+                    help='Follow the side of each branch that holds in a \
+                    model and check the other side only when exploring it')
+parser.add_argument('--merge-calls', action='store_true',
+                    help='Merge the code paths of each call that return \
+                    the same kind of result')
+parser.add_argument('--break-call-symmetry', action='store_true',
+                    help='Skip code paths that mirror another path by \
+                    swapping identical calls, for models whose calls \
+                    are interchangeable (symmetric_calls); with -c, \
+                    check that no conditions were lost')
+parser.add_argument('--finite-domains', action='store_true',
+                    help='Give bounded uninterpreted types exactly as many \
+                    values as test generation uses and expand quantifiers \
+                    over them')
+parser.add_argument('--incremental-testgen', action='store_true',
+                    help='Enumerate the tests of each path with one \
+                    incremental solver')
+parser.add_argument('--canonical-testgen', action='store_true',
+                    help='Enumerate the tests of each path by walking the \
+                    equality patterns of the first test\'s terms')
+parser.add_argument('--journal', metavar='FILE',
+                    help='Record finished call sets and paths in FILE')
+parser.add_argument('--resume', action='store_true',
+                    help='Skip the work recorded in the --journal and add \
+                    to the existing output files')
+parser.add_argument('--result-cache', metavar='DIR',
+                    help='Reuse the outputs of call sets whose model code \
+                    and options are unchanged since a run that cached them \
+                    in DIR (par-spec.py only)')
+parser.add_argument('--skip-disjoint', action='store_true',
+                    help='Report callsets whose calls touch disjoint state \
+                    fields as always commuting without testing them (not \
+                    with -t or -m)')
+parser.add_argument('--simplify-cache-size', type=int,
+                    default=simsym.options.simplify_cache_size,
+                    help='Maximum # simplified expressions to cache \
+                    (0 to disable)')
 parser.add_argument('module', metavar='MODULE', default='fs', action='store',
                     help='Module to test (e.g., models.fs)')
 
@@ -600,17 +1002,81 @@ def main(spec_args):
     args = spec_args
 
     z3printer._PP.max_lines = float('inf')
+    if args.fork_checkpoints and args.path_workers > 1:
+        parser.error("--fork-checkpoints and --path-workers are exclusive")
+    if args.break_call_symmetry and args.merge_calls:
+        parser.error("--break-call-symmetry and --merge-calls are exclusive")
+    simsym.options.fork_checkpoints = args.fork_checkpoints
+    simsym.options.path_workers = args.path_workers
+    simsym.options.search_strategy = args.search_strategy
+    simsym.options.search_seed = args.search_seed
+    simsym.options.max_path_depth = args.max_path_depth
+    simsym.options.sched_graph_file = args.sched_graph
+    simsym.options.sched_graph_sample = args.sched_graph_sample
+    simsym.options.query_cache_size = args.query_cache_size
+    simsym.options.simplify_cache_size = args.simplify_cache_size
+    simsym.options.solver_timeout = args.solver_timeout
+    simsym.options.query_trace_file = args.query_trace
+    simsym.options.query_dump_dir = args.query_dump
+    simsym.options.finite_domains = args.finite_domains
+    simsym.options.concolic = args.concolic
+    simsym.options.merge_calls = args.merge_calls
+    simsym.options.break_call_symmetry = args.break_call_symmetry
+    simsym.options.portfolio = tuple(filter(None, args.portfolio.split(',')))
     m = importlib.import_module(args.module)
     testgen = m.model_testgen if hasattr(m, 'model_testgen') else None
     if testgen is None and args.test_file:
         parser.error("No test case generator for this module")
+    if args.break_call_symmetry and \
+       not getattr(m.model_class, 'symmetric_calls', False):
+        parser.error("--break-call-symmetry requires a model whose "
+                     "identical calls are interchangeable (symmetric_calls)")
+    if args.skip_disjoint and args.test_file:
+        parser.error("--skip-disjoint would omit the tests of skipped callsets")
+    if args.skip_disjoint and args.model_file:
+        parser.error("--skip-disjoint would omit skipped callsets from the "
+                     "model file")
+    if args.result_cache:
+        parser.error("--result-cache is only supported by par-spec.py")
+    if args.resume:
+        if not args.journal:
+            parser.error("--resume requires --journal")
+        if args.test_file:
+            parser.error("--resume cannot add to a test file; "
+                         "par-spec.py can resume runs that generate tests")
+        if args.model_file and args.model_format != 'stream':
+            parser.error("--resume requires --model-format stream")
+
+    if args.query_trace and not args.resume:
+        # The trace is appended to by this process and any it forks,
+        # so start it here, before anything forks
+        open(args.query_trace, 'w').close()
+
+    journal = None
+    if args.journal:
+        try:
+            journal = RunJournal(args.journal, run_fingerprint(args, m),
+                                 args.resume)
+        except ValueError as e:
+            parser.error(str(e))
 
     test_writer = TestWriter(args.trace_file, args.model_file, args.test_file,
-                             testgen)
+                             testgen, args.model_format == 'stream', journal)
+    budget = simtest.BudgetMonitor(args.path_budget, args.time_budget,
+                                   args.solver_time_budget)
 
     for callset in parse_functions(args.functions, args.ncomb, m):
         calls = [getattr(m.model_class, callname) for callname in callset]
-        simtest.test_callset(m.model_class, calls, [test_writer],
+        if journal and '_'.join(callset) in journal.done_callsets:
+            print ' '.join(callset)
+            print '  already done (see %s)' % args.journal
+            continue
+        if args.skip_disjoint and \
+           simtest.disjoint_footprints(m.model_class, calls):
+            print ' '.join(callset)
+            print '  always commutes (disjoint footprints)'
+            continue
+        simtest.test_callset(m.model_class, calls, [budget, test_writer],
                              check_conds=args.check_conds,
                              print_conds=args.print_conds)
 
@@ -107,6 +107,10 @@ def _is_literal(z3ast):
         return z3.is_true(z3ast) or z3.is_false(z3ast)
     if z3ast.sort_kind() == z3.Z3_UNINTERPRETED_SORT:
         return z3.is_const(z3ast) and '!' in str(z3ast)
+    if z3ast.sort_kind() == z3.Z3_DATATYPE_SORT:
+        # Enumerations, including finite uninterpreted sorts
+        return z3.is_const(z3ast) and \
+            z3ast.decl().kind() == z3.Z3_OP_DT_CONSTRUCTOR
     raise NotImplementedError('Don\'t know how to literal-check %s' % z3ast)
 
 class DynamicDict(object):
@@ -0,0 +1,255 @@
+"""Reading and writing spec.py model files.
+
+A model file records every code path and test of a spec.py run (see
+spec.TestWriter for the schema).  There are two formats:
+
+* The nested format is a single JSON object,
+    {'tests': {callsetname: {pathid: pathinfo}},
+     'incomplete': {callsetname: reason}}
+  It can only be written once the run is done.
+
+* The stream format has one JSON object per line: a header record,
+  then a record for each call set as it begins, for each path as soon
+  as it is done, and for each call set that stopped early.  A run that
+  dies leaves every record written so far.  A call set may begin
+  more than once, such as when a resumed run repeats one that
+  stopped early; each beginning supersedes any earlier incomplete
+  record for it.  Closing a stream writes an index of the offset of
+  each path record to the file name plus '.idx'; see Index.
+
+The readers here accept either format.
+"""
+
+import collections
+import json
+import os
+
+__all__ = ['NestedWriter', 'StreamWriter', 'Index',
+           'open_append', 'records', 'iter_paths', 'load', 'export',
+           'merge']
+
+HEADER = {'type': 'header', 'format': 'model-stream', 'version': 1}
+
+def _loads(line):
+    return json.loads(line, object_pairs_hook=collections.OrderedDict)
+
+class NestedWriter(object):
+    """Write a nested format model file."""
+
+    def __init__(self, path):
+        self.path = path
+        self.data = {'tests': collections.OrderedDict(), 'incomplete': {}}
+
+    def begin_call_set(self, callset):
+        self.data['tests'].setdefault(callset, collections.OrderedDict())
+        # This run of callset supersedes any that stopped early
+        self.data['incomplete'].pop(callset, None)
+
+    def add_path(self, callset, pathid, pathinfo):
+        self.data['tests'][callset][pathid] = pathinfo
+
+    def incomplete_call_set(self, callset, reason):
+        self.data['incomplete'][callset] = reason
+
+    def close(self):
+        json.dump(self.data, file(self.path, 'w'), indent=2)
+
+def open_append(path):
+    """Open a file of JSON lines for appending.
+
+    If a run that died left a partial last line, this truncates it,
+    so appended lines start on a line of their own.
+    """
+    fp = file(path, 'r+')
+    end = 0
+    for line in iter(fp.readline, ''):
+        if not line.endswith('\n'):
+            break
+        end += len(line)
+    fp.seek(end)
+    fp.truncate()
+    return fp
+
+class StreamWriter(object):
+    """Write a stream format model file.
+
+    If append is true and path exists, this adds records to the
+    existing file, such as one left by an earlier run to resume.
+    """
+
+    def __init__(self, path, append=False):
+        self.path = path
+        if append and os.path.exists(path):
+            # {callset: {pathid: offset}}
+            self.__index = _scan(path)
+            self.__fp = open_append(path)
+            # The index of the earlier run won't cover the records
+            # added here, so readers must scan until close rewrites it
+            try:
+                os.unlink(path + '.idx')
+            except OSError:
+                pass
+        else:
+            self.__index = collections.OrderedDict()
+            self.__fp = file(path, 'w')
+            self.__write(HEADER)
+
+    def __write(self, rec):
+        offset = self.__fp.tell()
+        self.__fp.write(json.dumps(rec) + '\n')
+        self.__fp.flush()
+        return offset
+
+    def begin_call_set(self, callset):
+        self.__index.setdefault(callset, collections.OrderedDict())
+        self.__write({'type': 'callset', 'callset': callset})
+
+    def add_path(self, callset, pathid, pathinfo):
+        self.__index[callset][pathid] = self.__write(
+            {'type': 'path', 'callset': callset, 'pathid': pathid,
+             'info': pathinfo})
+
+    def incomplete_call_set(self, callset, reason):
+        self.__write({'type': 'incomplete', 'callset': callset,
+                      'reason': reason})
+
+    def get_path(self, callset, pathid):
+        """Return the pathinfo of a path already in the file.
+
+        Returns None if the file has no record of the path.
+        """
+        offset = self.__index.get(callset, {}).get(pathid)
+        if offset is None:
+            return None
+        with open(self.path) as fp:
+            fp.seek(offset)
+            return _loads(fp.readline())['info']
+
+    def close(self):
+        self.__fp.close()
+        json.dump(self.__index, file(self.path + '.idx', 'w'),
+                  separators=(',', ':'))
+
+class Index(object):
+    """Random access to the paths of a stream format model file.
+
+    This reads the index written when the file was closed or, if
+    there is none because the run died, rebuilds it by scanning the
+    file.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        try:
+            self.__index = json.load(
+                file(path + '.idx'),
+                object_pairs_hook=collections.OrderedDict)
+        except IOError:
+            self.__index = _scan(path)
+
+    def callsets(self):
+        """Return the list of call set names, in run order."""
+        return self.__index.keys()
+
+    def pathids(self, callset):
+        """Return the list of path IDs of callset, in run order."""
+        return self.__index[callset].keys()
+
+    def get(self, callset, pathid):
+        """Return the pathinfo of the given path."""
+        with open(self.path) as fp:
+            fp.seek(self.__index[callset][pathid])
+            return _loads(fp.readline())['info']
+
+def _scan(path):
+    # Build the index of a stream file by reading it
+    index = collections.OrderedDict()
+    with open(path) as fp:
+        while True:
+            offset = fp.tell()
+            line = fp.readline()
+            if not line.endswith('\n'):
+                break
+            rec = json.loads(line)
+            if rec['type'] in ('callset', 'path'):
+                paths = index.setdefault(rec['callset'],
+                                         collections.OrderedDict())
+            if rec['type'] == 'path':
+                paths[rec['pathid']] = offset
+    return index
+
+def _stream_records(fp):
+    # Stream files begin with a header record.  Nested files begin
+    # with a line that isn't a complete JSON object.
+    first = fp.readline()
+    try:
+        rec = json.loads(first)
+    except ValueError:
+        rec = None
+    if not isinstance(rec, dict) or rec.get('type') != 'header':
+        fp.seek(0)
+        return None
+    if rec.get('version') != HEADER['version']:
+        raise ValueError('Unknown model stream version %r' %
+                         rec.get('version'))
+    # A run that died may have left a partial last line
+    return (_loads(line) for line in fp if line.endswith('\n'))
+
+def _nested_records(data):
+    for callset, paths in data['tests'].iteritems():
+        yield {'type': 'callset', 'callset': callset}
+        for pathid, pathinfo in paths.iteritems():
+            yield {'type': 'path', 'callset': callset, 'pathid': pathid,
+                   'info': pathinfo}
+    for callset, reason in data.get('incomplete', {}).iteritems():
+        yield {'type': 'incomplete', 'callset': callset, 'reason': reason}
+
+def records(fp):
+    """Return an iterator over the records of model file fp.
+
+    fp may be in either format.  Records are as in the stream format.
+    """
+    recs = _stream_records(fp)
+    if recs is None:
+        recs = _nested_records(
+            json.load(fp, object_pairs_hook=collections.OrderedDict))
+    return recs
+
+def iter_paths(fp):
+    """Yield (callset, pathid, pathinfo) for each path in model file fp."""
+    for rec in records(fp):
+        if rec['type'] == 'path':
+            yield rec['callset'], rec['pathid'], rec['info']
+
+def _replay(fp, writer):
+    for rec in records(fp):
+        if rec['type'] == 'callset':
+            writer.begin_call_set(rec['callset'])
+        elif rec['type'] == 'path':
+            writer.add_path(rec['callset'], rec['pathid'], rec['info'])
+        elif rec['type'] == 'incomplete':
+            writer.incomplete_call_set(rec['callset'], rec['reason'])
+
+def load(fp):
+    """Return the nested form of model file fp."""
+    writer = NestedWriter(None)
+    _replay(fp, writer)
+    return writer.data
+
+def export(fp, out):
+    """Write model file fp to path out in the nested format."""
+    writer = NestedWriter(out)
+    _replay(fp, writer)
+    writer.close()
+
+def merge(ins, out, stream=False):
+    """Merge the model files at paths ins into a model file at path out.
+
+    If stream is true, out is written in the stream format; otherwise
+    it is written in the nested format.
+    """
+    writer = StreamWriter(out) if stream else NestedWriter(out)
+    for inpath in ins:
+        with open(inpath) as fp:
+            _replay(fp, writer)
+    writer.close()
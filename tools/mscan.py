@@ -1,6 +1,7 @@
 import json
 import collections
 from enum import Enumerable
+import modelfile
 
 TestCase = collections.namedtuple('TestCase', 'calls path test shared')
 
@@ -141,16 +142,14 @@ def model_tests(fp):
     did not generate any tests are excluded.
     """
 
-    data = json.load(fp)
     models = []
-    for calls, paths in data['tests'].iteritems():
-        for pathinfo in paths.itervalues():
-            path = pathinfo['id']
-            for testinfo in pathinfo.get('tests', []):
-                test = testinfo['id']
-                models.append(TestModel(
-                    calls=calls, path=path, test=test,
-                    idempotent_projs=testinfo.get('idempotent_projs', None),
-                    idempotence_unknown=testinfo.get('idempotence_unknown', 0),
-                    assignments=testinfo['assignments']))
+    for calls, _, pathinfo in modelfile.iter_paths(fp):
+        path = pathinfo['id']
+        for testinfo in pathinfo.get('tests', []):
+            test = testinfo['id']
+            models.append(TestModel(
+                calls=calls, path=path, test=test,
+                idempotent_projs=testinfo.get('idempotent_projs', None),
+                idempotence_unknown=testinfo.get('idempotence_unknown', 0),
+                assignments=testinfo['assignments']))
     return Enumerable.from_iterable(models)
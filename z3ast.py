@@ -0,0 +1,133 @@
+"""DAG-aware traversal of Z3 ASTs.
+
+Z3 expressions share subterms, so walking an expression as a tree
+visits a shared subterm once per occurrence, which can take time
+exponential in the size of the expression.  The functions here visit
+each distinct node once, identifying nodes by their AST id.
+"""
+
+import z3
+
+def children(e):
+    """Return the immediate subterms of Z3 AST e."""
+    if z3.is_quantifier(e):
+        return [e.body()]
+    if z3.is_app(e):
+        return e.children()
+    return []
+
+def is_free_var(e):
+    """Return True if e is an uninterpreted constant.
+
+    These are what people normally think of as "variables", including
+    values that belong to universes of uninterpreted sorts.
+    Quantifier-bound variables are not free variables.
+    """
+    return z3.is_const(e) and e.decl().kind() == z3.Z3_OP_UNINTERPRETED
+
+def walk(expr):
+    """Yield each distinct node of Z3 AST expr once, parents first."""
+    seen, stack = set(), [expr]
+    while stack:
+        e = stack.pop()
+        eid = e.get_id()
+        if eid in seen:
+            continue
+        seen.add(eid)
+        yield e
+        stack.extend(children(e))
+
+def size(expr):
+    """Return the number of distinct nodes in Z3 AST expr."""
+    return sum(1 for _ in walk(expr))
+
+def depth(expr):
+    """Return the length of the longest path from expr to a leaf.
+
+    A leaf has depth 0.
+    """
+    depths, stack = {}, [(expr, False)]
+    while stack:
+        e, expanded = stack.pop()
+        eid = e.get_id()
+        if eid in depths:
+            continue
+        kids = children(e)
+        if expanded:
+            depths[eid] = 1 + max(depths[k.get_id()] for k in kids)
+        elif not kids:
+            depths[eid] = 0
+        else:
+            stack.append((e, True))
+            stack.extend((k, False) for k in kids)
+    return depths[expr.get_id()]
+
+# Maximum number of nodes to keep in _free_vars before starting over
+max_cached = 1 << 20
+
+# Mapping from AST id to (AST, frozenset of the ids of the AST's free
+# variables).  Holding the AST keeps Z3 from reusing its id, so the
+# cache is only cleared before a query begins (see _trim), never
+# between the free_vars calls of one comparison.
+_free_vars = {}
+
+_empty = frozenset()
+
+def _trim():
+    # Start the cache over if it has grown too large
+    if len(_free_vars) > max_cached:
+        _free_vars.clear()
+
+def free_vars(expr):
+    """Return the frozenset of the ids of the free variables of expr.
+
+    The free variable set of every node visited is cached, so asking
+    again about expr or any of its subterms takes constant time.
+    Variable ids can be compared between expressions (see
+    isdisjoint) or turned back into ASTs with free_var_asts.  Ids
+    from different calls are only comparable while the caller holds
+    the expressions, since a later call may clear the cache.
+    """
+    _trim()
+    return _cached_free_vars(expr)
+
+def _cached_free_vars(expr):
+    eid = expr.get_id()
+    if eid in _free_vars:
+        return _free_vars[eid][1]
+
+    stack = [(expr, False)]
+    while stack:
+        e, expanded = stack.pop()
+        eid = e.get_id()
+        if eid in _free_vars:
+            continue
+        if is_free_var(e):
+            _free_vars[eid] = (e, frozenset([eid]))
+            continue
+        kids = children(e)
+        if expanded:
+            sets = set(_free_vars[k.get_id()][1] for k in kids)
+            sets.discard(_empty)
+            if not sets:
+                res = _empty
+            elif len(sets) == 1:
+                # Share the set of the only child with free variables
+                res = sets.pop()
+            else:
+                res = frozenset().union(*sets)
+            _free_vars[eid] = (e, res)
+        else:
+            stack.append((e, True))
+            stack.extend((k, False) for k in kids
+                         if k.get_id() not in _free_vars)
+    return _free_vars[expr.get_id()][1]
+
+def free_var_asts(expr):
+    """Return a list of the free variables of expr."""
+    return [_free_vars[vid][0] for vid in free_vars(expr)]
+
+def isdisjoint(a, b):
+    """Return True if Z3 ASTs a and b have no free variable in common."""
+    _trim()
+    return _cached_free_vars(a).isdisjoint(_cached_free_vars(b))
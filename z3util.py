@@ -1,6 +1,7 @@
 import collections
 import z3
 import simsym
+import z3ast
 
 def predicates(expr):
     """Return a list of Z3 predicate names satisfied by expr.
@@ -31,6 +32,10 @@ def predicates(expr):
 
     return res
 
+def dag_size(expr):
+    """Return the number of distinct nodes in Z3 expression expr."""
+    return z3ast.size(expr)
+
 class HashableAst(object):
     """Wrapper for simsym/Z3 ASTs for Python hashing and equality.
 